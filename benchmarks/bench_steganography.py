@@ -0,0 +1,186 @@
+# Benchmarks for the hide/extract hot paths.
+#
+#   python benchmarks/bench_steganography.py -o report.json
+#   python benchmarks/bench_steganography.py -o new.json --compare report.json
+#
+# Every case runs in a fresh process so peak RSS is measured per case.
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+from steganography_hide import hide
+from steganography_extract import extract
+from steganography_utils import HEADER_BYTES, _image_capacity, _unframed_capacity, _embed_data_in_image, _bits_to_bytes
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MEGAPIXELS = [0.1, 1, 10, 50]
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]  # Plus the carrier's full capacity
+FORMATS = ["png", "bmp", "tiff"]
+MAX_BITS_TO_BYTES_PAYLOAD = 8 * 1024 * 1024  # '0'/'1' strings grow 8x, keep them reasonable
+MIN_REGRESSION_SECONDS = 0.005  # Ignore slowdowns smaller than timer noise
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _make_carrier(folder, megapixels, fmt):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1_000_000 // width)
+    path = os.path.join(folder, f"carrier_{megapixels}mp.{fmt}")
+    if not os.path.exists(path):
+        rng = np.random.default_rng(0)
+        Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).save(path)
+    return path, width, height
+
+def _make_payload(folder, size):
+    path = os.path.join(folder, f"payload_{size}.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(np.random.default_rng(1).integers(0, 256, size, dtype=np.uint8).tobytes())
+    return path
+
+def _make_stego(case):
+    # Runs in its own process, so hiding never counts towards the peak RSS of the extract case
+    stego = os.path.join(case["folder"], f"stego_{case['megapixels']}mp_{case['payload_bytes']}.{case['format']}")
+    if not os.path.exists(stego):
+        hide(case["payload"], case["carrier"], stego)
+    return stego
+
+def _run_case(case):
+    # Runs in its own process; setup is kept out of the timed section, and hide() and extract()
+    # read the payload from disk themselves, so only the in-memory targets load it
+    folder = case["folder"]
+    if case["target"] == "hide":
+        output = os.path.join(folder, f"out_{os.getpid()}.{case['format']}")
+        start = time.perf_counter()
+        hide(case["payload"], case["carrier"], output)
+        seconds = time.perf_counter() - start
+    elif case["target"] == "extract":
+        start = time.perf_counter()
+        extract(case["stego"], os.path.join(folder, f"extracted_{os.getpid()}"))
+        seconds = time.perf_counter() - start
+    elif case["target"] == "_embed_data_in_image":
+        payload = _read_payload(case)
+        image = Image.open(case["carrier"]).convert("RGB")
+        start = time.perf_counter()
+        _embed_data_in_image(image, payload)
+        seconds = time.perf_counter() - start
+    else:
+        bits = ''.join(format(byte, '08b') for byte in _read_payload(case))
+        start = time.perf_counter()
+        _bits_to_bytes(bits)
+        seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": _peak_rss_mb(),
+        "throughput_mb_s": case["payload_bytes"] / (1024 * 1024) / seconds if seconds else None,
+    }
+
+def _read_payload(case):
+    with open(case["payload"], "rb") as f:
+        return f.read()
+
+def _in_fresh_process(context, fn, case):
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, case).result()
+
+def _cases(folder, megapixels, payload_sizes, formats):
+    for mp in megapixels:
+        carriers = {fmt: _make_carrier(folder, mp, fmt) for fmt in formats}
+        _, width, height = carriers[formats[0]]
+        # hide() checksums every frame by default, which takes its share of the capacity
+        capacity = _unframed_capacity(_image_capacity(width, height) - HEADER_BYTES - len("bin"))
+        for size in sorted({s for s in payload_sizes if s <= capacity} | {capacity}):
+            payload = _make_payload(folder, size)
+            base = {"folder": folder, "megapixels": mp, "payload_bytes": size, "payload": payload}
+            for fmt in formats:
+                for target in ("hide", "extract"):
+                    yield dict(base, target=target, format=fmt, carrier=carriers[fmt][0])
+            yield dict(base, target="_embed_data_in_image", format=None, carrier=carriers[formats[0]][0])
+            if size <= MAX_BITS_TO_BYTES_PAYLOAD:
+                yield dict(base, target="_bits_to_bytes", format=None, carrier=None)
+
+def _case_key(result):
+    return f"{result['target']}|{result['format']}|{result['megapixels']}|{result['payload_bytes']}"
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(megapixels, payload_sizes, formats, repeat):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as folder:
+        for case in _cases(folder, megapixels, payload_sizes, formats):
+            if case["target"] == "extract":
+                case = dict(case, stego=_in_fresh_process(context, _make_stego, case))
+            runs = [_in_fresh_process(context, _run_case, case) for _ in range(repeat)]
+            best = min(runs, key=lambda r: r["seconds"])
+            result = {key: case[key] for key in ("target", "format", "megapixels", "payload_bytes")}
+            result.update(best)
+            results.append(result)
+            print(f"{_case_key(result):60s} {best['seconds']:9.4f}s "
+                  f"{best['throughput_mb_s'] or 0:9.2f} MB/s {best['peak_rss_mb'] or 0:9.1f} MB RSS", flush=True)
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def compare(report, baseline, threshold):
+    # Returns the cases that got slower than the baseline by more than `threshold`
+    previous = {_case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(_case_key(result))
+        if (old and result["seconds"] > old["seconds"] * (1 + threshold)
+                and result["seconds"] - old["seconds"] > MIN_REGRESSION_SECONDS):
+            regressions.append((_case_key(result), old["seconds"], result["seconds"]))
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark hide/extract across carrier sizes, payload sizes and formats.")
+    parser.add_argument('-m', '--megapixels', type=float, nargs='+', default=MEGAPIXELS, help="Carrier sizes in megapixels.")
+    parser.add_argument('-p', '--payload-sizes', type=int, nargs='+', default=PAYLOAD_SIZES, help="Payload sizes in bytes; the carrier capacity is always added.")
+    parser.add_argument('-f', '--formats', nargs='+', default=FORMATS, choices=FORMATS, help="Carrier formats.")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per case, the fastest one is kept.")
+    parser.add_argument('-o', '--output', required=True, help="Where to write the JSON report.")
+    parser.add_argument('-c', '--compare', help="A previous JSON report to check for regressions.")
+    parser.add_argument('-t', '--threshold', type=float, default=0.2, help="Slowdown ratio that counts as a regression.")
+
+    args = parser.parse_args()
+    report = run(args.megapixels, args.payload_sizes, args.formats, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for key, old, new in regressions:
+            print(f"REGRESSION {key}: {old:.4f}s -> {new:.4f}s")
+        sys.exit(1 if regressions else 0)
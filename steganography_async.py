@@ -0,0 +1,66 @@
+import os
+import asyncio
+import weakref
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from steganography_hide import hide_bytes
+from steganography_extract import extract_bytes
+from steganography_utils import PAYLOAD_CHUNK_SIZE
+
+_executor = None
+_max_concurrent = None
+_gates = weakref.WeakKeyDictionary()  # Event loop -> its semaphore, a semaphore only works on one loop
+
+def configure(max_workers=None, max_concurrent=None):
+    # max_workers: threads running the blocking decode, embed and encode stages
+    # max_concurrent: requests allowed to use them at once per event loop, the rest wait on the loop without holding a thread
+    global _executor, _max_concurrent
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    max_workers = max_workers or os.cpu_count()
+    _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="steganography")
+    _max_concurrent = max_concurrent or 2 * max_workers
+    _gates.clear()
+
+def _limits():
+    # Must be called from a coroutine; each event loop gets its own gate, created on first use
+    if _executor is None:
+        configure()
+    loop = asyncio.get_running_loop()
+    gate = _gates.get(loop)
+    if gate is None:
+        gate = _gates[loop] = asyncio.Semaphore(_max_concurrent)
+    return _executor, gate
+
+async def _run(fn, *args, **kwargs):
+    executor, _ = _limits()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+async def _collect(source):
+    # bytes-like or async iterable of bytes -> bytes-like
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    data = bytearray()
+    async for chunk in source:
+        data += chunk
+    return data
+
+async def async_hide(payload, carrier, ext="", output_format="PNG", **options):
+    # payload, carrier: bytes or async iterables of bytes, e.g. aiohttp's request.content.iter_chunked(n)
+    # Yields the encoded image chunk by chunk; options are passed on to hide_bytes()
+    _, gate = _limits()
+    payload = await _collect(payload)
+    carrier = await _collect(carrier)
+    async with gate:
+        encoded = await _run(hide_bytes, payload, carrier, ext, output_format, **options)
+    # Stream the result outside the gate, a slow client should not hold up other requests
+    view = memoryview(encoded)
+    for start in range(0, len(view), PAYLOAD_CHUNK_SIZE):
+        yield view[start:start + PAYLOAD_CHUNK_SIZE]
+
+async def async_extract(image, **options):
+    # image: bytes or an async iterable of bytes; returns (ext, payload bytes)
+    _, gate = _limits()
+    image = await _collect(image)
+    async with gate:
+        return await _run(extract_bytes, image, **options)
@@ -0,0 +1,106 @@
+import os
+import sys
+import csv
+import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from steganography_hide import hide
+from steganography_extract import extract
+from steganography_utils import _list_images
+
+def _read_manifest(path):
+    # CSV with a header row, or JSONL with one object per line
+    with open(path, newline='') as f:
+        if path.lower().endswith((".jsonl", ".json")):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+SECRET_FIELDS = ("key", "passphrase")  # Manifest columns never echoed into the results
+
+def _run_job(task, job):
+    start = time.perf_counter()
+    try:
+        if task == "hide":
+            hide(job["file"], job["image"], job["output"], key=job.get("key") or None, passphrase=job.get("passphrase") or None)
+        else:
+            extract(job["image"], job["output"], key=job.get("key") or None, passphrase=job.get("passphrase") or None)
+    except Exception as e:
+        return dict(_public_fields(job), status="error", error=str(e), seconds=time.perf_counter() - start)
+    return dict(_public_fields(job), status="ok", seconds=time.perf_counter() - start)
+
+def _public_fields(job):
+    return {name: value for name, value in job.items() if name not in SECRET_FIELDS}
+
+def run_batch(task, jobs, workers=None):
+    # Runs "hide" or "extract" jobs over a process pool, yields a result per job as it finishes.
+    # Jobs sharing an output would overwrite each other, so they are reported as errors and not run
+    outputs = Counter(os.path.abspath(job["output"]) for job in jobs)
+    runnable = []
+    for job in jobs:
+        if outputs[os.path.abspath(job["output"])] > 1:
+            yield dict(_public_fields(job), status="error", error="Another job writes the same output.", seconds=0.0)
+        else:
+            runnable.append(job)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_job, task, job) for job in runnable]
+        for future in as_completed(futures):
+            yield future.result()
+
+def _hide_jobs(args):
+    if args.manifest:
+        return _read_manifest(args.manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+    # The carrier's own extension stays in the name, so c.bmp and c.png do not both become c.png
+    return [
+        {"file": args.file, "image": image, "output": os.path.join(args.output_dir, os.path.basename(image) + ".png")}
+        for image in _list_images(args.image_dir)
+    ]
+
+def _extract_jobs(args):
+    if args.manifest:
+        return _read_manifest(args.manifest)
+    return [
+        {"image": image, "output": os.path.join(args.output_dir, os.path.basename(image))}
+        for image in _list_images(args.image_dir)
+    ]
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # Needed for the worker processes of frozen executables
+    parser = argparse.ArgumentParser(description="Hide or extract files for many images at once.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    hide_parser = subparsers.add_parser("hide-batch", help="Hide files inside many images.")
+    hide_parser.add_argument('-m', '--manifest', help="CSV or JSONL manifest with file, image and output columns, and optional key and passphrase columns.")
+    hide_parser.add_argument('-f', '--file', help="The file to hide in every image of --image-dir.")
+    hide_parser.add_argument('-d', '--image-dir', help="Directory of carrier images.")
+    hide_parser.add_argument('-o', '--output-dir', help="Directory for the output images.")
+
+    extract_parser = subparsers.add_parser("extract-batch", help="Extract hidden files from many images.")
+    extract_parser.add_argument('-m', '--manifest', help="CSV or JSONL manifest with image and output columns, and optional key and passphrase columns.")
+    extract_parser.add_argument('-d', '--image-dir', help="Directory of images with hidden files.")
+    extract_parser.add_argument('-o', '--output-dir', help="Directory to extract into, one folder per image.")
+
+    for sub in (hide_parser, extract_parser):
+        sub.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="Number of worker processes.")
+
+    args = parser.parse_args()
+    if args.command == "hide-batch":
+        if not args.manifest and not (args.file and args.image_dir and args.output_dir):
+            parser.error("hide-batch needs --manifest or --file, --image-dir and --output-dir.")
+        task, jobs = "hide", _hide_jobs(args)
+    else:
+        if not args.manifest and not (args.image_dir and args.output_dir):
+            parser.error("extract-batch needs --manifest or --image-dir and --output-dir.")
+        task, jobs = "extract", _extract_jobs(args)
+
+    failed = 0
+    for result in run_batch(task, jobs, args.workers):
+        failed += result["status"] != "ok"
+        print(json.dumps(result), flush=True)
+
+    print(f"{len(jobs) - failed} succeeded, {failed} failed", file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+from steganography_utils import MAX_BITS_PER_CHANNEL, _image_capacity, _open_image, _iter_file_chunks, _list_images
+
+CATALOG_NAME = ".steganography_catalog.json"  # Kept inside the pool directory
+CATALOG_VERSION = 1
+
+def update_catalog(directory):
+    # Scans the carrier images of `directory` and returns the refreshed catalog; only images that
+    # are new or whose mtime or size changed are opened again, removed images are dropped.
+    # Carriers are kept sorted by pixel count, which orders every capacity column at once
+    previous = {entry["name"]: entry for entry in load_catalog(directory)["carriers"]}
+    carriers = []
+    for image_path in _list_images(directory):
+        name = os.path.basename(image_path)
+        stat = os.stat(image_path)
+        entry = previous.get(name)
+        if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["bytes"] != stat.st_size:
+            try:
+                entry = _catalog_entry(image_path, stat)
+            except OSError:
+                continue  # Not an image PIL can read
+        carriers.append(entry)
+
+    carriers.sort(key=_carrier_order)
+    catalog = {"version": CATALOG_VERSION, "carriers": carriers}
+    save_catalog(directory, catalog)
+    return catalog
+
+def _carrier_order(entry):
+    return entry["width"] * entry["height"], entry["name"]
+
+def _unused_carriers(catalog):
+    # The carriers that never hid a file, in catalog order; built once per catalog, kept in it
+    # but never saved, and updated by mark_used
+    if "unused" not in catalog:
+        catalog["unused"] = [entry for entry in catalog["carriers"] if not entry["uses"]]
+    return catalog["unused"]
+
+def _catalog_entry(image_path, stat):
+    # Dimensions, mode and format come from the image header; the pixels are never decoded
+    with _open_image(image_path) as img:
+        width, height, mode, fmt = img.width, img.height, img.mode, img.format
+    sha256 = hashlib.sha256()
+    for chunk in _iter_file_chunks(image_path):
+        sha256.update(chunk)
+    return {
+        "name": os.path.basename(image_path),
+        "mtime_ns": stat.st_mtime_ns,
+        "bytes": stat.st_size,
+        "width": width,
+        "height": height,
+        "mode": mode,
+        "format": fmt,
+        # Container bytes at 1..MAX_BITS_PER_CHANNEL bits per channel
+        "capacity": [_image_capacity(width, height, bpc) for bpc in range(1, MAX_BITS_PER_CHANNEL + 1)],
+        "alpha_capacity": [_image_capacity(width, height, bpc, True) for bpc in range(1, MAX_BITS_PER_CHANNEL + 1)],
+        "sha256": sha256.hexdigest(),
+        "uses": 0,
+        "last_used": None,
+    }
+
+def load_catalog(directory):
+    try:
+        with open(os.path.join(directory, CATALOG_NAME)) as f:
+            catalog = json.load(f)
+    except FileNotFoundError:
+        return {"version": CATALOG_VERSION, "carriers": []}
+    if catalog.get("version") != CATALOG_VERSION:
+        return {"version": CATALOG_VERSION, "carriers": []}  # Rebuilt from scratch by update_catalog
+    return catalog
+
+def save_catalog(directory, catalog):
+    # Written to a temporary file first, so an interrupted save never leaves half a catalog
+    path = os.path.join(directory, CATALOG_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"version": catalog["version"], "carriers": catalog["carriers"]}, f)
+    os.replace(path + ".tmp", path)
+
+def pick_from_catalog(catalog, needed, bits_per_channel=1, use_alpha=False, reuse=False):
+    # Smallest carrier holding `needed` container bytes, found by bisection over the sorted unused carriers;
+    # reuse: bisect all carriers instead, including those that already hid a file
+    column = "alpha_capacity" if use_alpha else "capacity"
+    carriers = catalog["carriers"] if reuse else _unused_carriers(catalog)
+    index = bisect.bisect_left(carriers, needed, key=lambda entry: entry[column][bits_per_channel - 1])
+    if index == len(carriers):
+        raise ValueError("No carrier in the pool is large enough to hold the data.")
+    return carriers[index]
+
+def mark_used(directory, catalog, entry):
+    if not entry["uses"] and "unused" in catalog:
+        unused = catalog["unused"]
+        index = bisect.bisect_left(unused, _carrier_order(entry), key=_carrier_order)
+        if index < len(unused) and unused[index] is entry:
+            del unused[index]
+    entry["uses"] += 1
+    entry["last_used"] = time.time()
+    save_catalog(directory, catalog)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or refresh the catalog of a carrier pool directory.")
+    parser.add_argument('directory', help="Directory of carrier images.")
+
+    args = parser.parse_args()
+    catalog = update_catalog(args.directory)
+    carriers = catalog["carriers"]
+    unused = sum(1 for entry in carriers if not entry["uses"])
+    print(f"{len(carriers)} carriers, {unused} unused, {sum(entry['capacity'][0] for entry in carriers)} bytes at 1 bit per channel")
@@ -1,49 +1,300 @@
+import io
 import os
-from PIL import Image
-from steganography_utils import _get_lsb_bits, _parse_sizes, _bits_to_bytes, _print_progress
-
-def extract(image_path, output_folder):
-    image = Image.open(image_path).convert("RGB")
-    pixels = list(image.getdata())
-    
-    flat_bits = ''
-    total_pixels = len(pixels)
-    last_progress = -1  # Track the last progress percentage for extraction
-    
-    # Track progress while extracting bits from the image pixels
-    for idx, pixel in enumerate(pixels):
-        flat_bits += _get_lsb_bits(pixel)
-        
-        # Calculate the progress percentage for extraction
-        percent = (idx + 1) / total_pixels * 100
-        percent = int(percent // 5 * 5)  # Round to nearest multiple of 5
-        
-        # Print progress only if the percentage has moved by 5%
-        if percent > last_progress:
-            _print_progress(idx + 1, total_pixels, "Extracting hidden data", percent)
-            last_progress = percent
-    
-    size, ext_size = _parse_sizes(flat_bits)
-    
-    ext = _bits_to_bytes(flat_bits[64:64 + (ext_size * 8)]).decode('utf-8')
-    file_data = _bits_to_bytes(flat_bits[64 + (ext_size * 8):64 + (ext_size * 8) + (size * 8)])
+import sys
+import functools
+import math
+import zlib
+import tempfile
+import contextlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from steganography_utils import HEADER_BYTES, HEADER_PIXELS, LEGACY_HEADER_BYTES, FLAG_SHARDED, FLAG_ALPHA, FLAG_SCATTER, FLAG_ENCRYPTED, FLAG_FRAMED, ENCRYPTION_BYTES, PASSPHRASE_ENV, HEADER_BITS, UnsupportedVersionError, _scatter_order, _encryption_keys, _encryption_ad, _iter_decrypted, _iter_unframed, _as_mode, _pixel_views, _read_lsb_bytes, _raw_pixel_layout, _raw_views, _open_image, _check_decode, _decode_rows, _unpack_header, _unpack_legacy_header, _shard_bytes, _unpack_shard, _flags_bpc, _flags_codec, _iter_decompressed, _channels_needed, _carrier_channels, _pixels_needed, _as_buffer, _open_for_write, _no_progress, console_progress, prompt_passphrase, PAYLOAD_CHUNK_SIZE
+
+def extract(image_path, output_folder, progress=None, key=None, passphrase=None):
+    # progress: optional callable(current, total, task_name), called once per chunk
+    # key, passphrase: the ones the file was hidden with, if any
+    _extract_into(image_path, functools.partial(_open_output, output_folder), progress, key, passphrase)
+
+def extract_to(image_path, stream, progress=None, key=None, passphrase=None):
+    # stream: any writable binary object (file, pipe, sys.stdout.buffer, socket.makefile("wb")),
+    # payload chunks are written to it as they are decoded and it is left open; returns the extension
+    return _extract_into(image_path, lambda ext: _open_for_write(stream), progress, key, passphrase)
+
+def _extract_into(image_path, open_output, progress, key=None, passphrase=None):
+    # open_output(ext) returns a context manager giving the binary file to write to
+    progress = progress or _no_progress
+    if isinstance(image_path, (list, tuple)):
+        return _extract_sharded(list(image_path), open_output, progress, key, passphrase)
     
-    os.makedirs(output_folder, exist_ok=True)
-    output_path = os.path.join(output_folder, f"extracted_file.{ext}")
+    container = _load_whole_container(image_path, key)
+    _write_output(open_output, container.ext, _iter_plaintext(container, _container_keys(container, passphrase), progress))
+    return container.ext
+
+def extract_bytes(image, progress=None, key=None, passphrase=None):
+    # image: bytes-like or a binary file object; returns (ext, payload bytes)
+    container = _load_whole_container(_as_buffer(image), key)
+    buffer = io.BytesIO()
+    for data in _iter_plaintext(container, _container_keys(container, passphrase), progress or _no_progress):
+        buffer.write(data)
+    return container.ext, buffer.getvalue()
+
+def _load_whole_container(source, key=None):
+    container = _load_container(source, key)
+    if container.shard is not None and container.shard[1] != 1:
+        raise ValueError("Image holds one shard of a larger file, pass all of its images.")
+    return container
+
+def _container_keys(container, passphrase):
+    # Derived before any output is opened, so a missing passphrase leaves nothing behind
+    return None if container.encryption is None else _encryption_keys(passphrase, *container.encryption)
+
+def _iter_plaintext(container, keys, progress):
+    # Decode, check, decrypt and decompress the payload one chunk at a time
+    return _iter_decompressed(_iter_checked(container, keys, progress), container.codec)
+
+def _write_output(open_output, ext, chunks):
+    # The first chunk is decoded before the output is opened, so a wrong passphrase
+    # or a damaged first frame fails without creating anything
+    first = next(chunks, b"")
+    with open_output(ext) as f:
+        f.write(first)
+        for data in chunks:
+            f.write(data)
+
+def _iter_checked(container, keys, progress):
+    # Stored payload with its frames checked and, given keys, decrypted; stops at the first bad frame
+    chunks = _iter_payload(container, progress)
+    if container.framed:
+        chunks = _iter_unframed(chunks)
+    if keys is not None:
+        chunks = _iter_decrypted(chunks, keys)
+    return chunks
+
+def verify(image_path, key=None, passphrase=None):
+    # Reads the hidden file through its checksums without writing or decompressing it and returns
+    # the checksum that vouched for it: "frames", "crc32", "tags", or None when nothing could.
+    # Raises ValueError at the first damaged frame. The tags of a sharded file run across all of its
+    # shards, so a single shard is only checked through its frames
+    container = _load_container(image_path, key)
+    whole = container.shard is None or container.shard[1] == 1
+    keys = _container_keys(container, passphrase) if container.encryption is not None and passphrase is not None and whole else None
+    for _ in _iter_checked(container, keys, _no_progress):
+        pass
+    if container.framed:
+        return "frames"
+    if container.crc is not None:
+        return "crc32"
+    return "tags" if keys is not None else None
+
+def has_hidden_file(image_path):
+    # Decodes only the header pixels where the format allows it, so clean images are rejected
+    # without reading the rest of the file
+    try:
+        _read_header(*_load_pixels(image_path, pixel_count=HEADER_PIXELS))
+    except UnsupportedVersionError:
+        return True  # Hidden by a newer writer, which extract() then refuses
+    except ValueError:
+        return False
+    return True
+
+def _iter_payload(container, progress):
+    size = container.size
+    crc = 0
+    for start in range(0, size, PAYLOAD_CHUNK_SIZE):
+        length = min(PAYLOAD_CHUNK_SIZE, size - start)
+        data = _read_payload(container, start, length)
+        if container.crc is not None:  # Framed and encrypted payloads are checked frame by frame instead
+            crc = zlib.crc32(data, crc)
+        yield data
+        progress(start + length, size, "Extracting hidden data")
+    _check_crc(container, crc)
+
+def _check_crc(container, crc):
+    # Legacy containers carry no checksum
+    if container.crc is not None and crc != container.crc:
+        raise ValueError(_corrupted_message(container.order))
+
+def _corrupted_message(order):
+    # A wrong key reads the right channels in the wrong order, which looks like corruption
+    return "Hidden file is corrupted or the key is wrong." if order is not None else "Hidden file is corrupted."
+
+# views: channel views in embedding order, shard: (index, count) or None,
+# shard_id: random id shared by the shards of one file, None for whole files and older shard records,
+# offset: container offset of the first payload byte, crc: None for legacy containers,
+# order: keyed order of the channels after the header, None when they run in sequence,
+# encryption: (encryption record, associated data of the frame tags), None when the payload is stored in the clear,
+# framed: the stored payload carries a CRC32 per CHECKSUM_FRAME bytes
+_Container = namedtuple("_Container", "views size ext shard shard_id offset bits_per_channel codec crc order encryption framed")
+_Header = namedtuple("_Header", "size ext_size flags crc header_bytes")
+
+def _load_container(source, key=None, payload=True):
+    # Reads the header from the first pixels, then decodes only the rows the container spans;
+    # payload=False stops at the records before the payload, which is then left unreadable
+    pixels, image_size = _load_pixels(source, pixel_count=HEADER_PIXELS)
+    header = _read_header(pixels, image_size)
+    end = _container_end(header) if payload else _payload_offset(header)
+    pixel_count = _pixels_needed(_channels_needed(end, _flags_bpc(header.flags)), bool(header.flags & FLAG_ALPHA))
+    if header.flags & FLAG_SCATTER:
+        pixel_count = image_size[0] * image_size[1]  # Scattered data can sit anywhere in the image
+    if sum(block.shape[0] for block in pixels) * image_size[0] < pixel_count:
+        pixels, image_size = _load_pixels(source, pixel_count=pixel_count)
+    return _read_container(pixels, image_size, key)
+
+def _container_end(header):
+    return _payload_offset(header) + header.size
+
+def _payload_offset(header):
+    # Header, extension, then the shard and encryption records of the containers that have them
+    flags = header.flags
+    return header.header_bytes + header.ext_size + _shard_bytes(flags) + (ENCRYPTION_BYTES if flags & FLAG_ENCRYPTED else 0)
+
+def _load_pixels(source, pixel_count=None):
+    # source: image path or the encoded image as a bytes-like object
+    # Returns (pixel blocks, image size); pixel_count: only the first pixels are needed
+    is_path = isinstance(source, (str, os.PathLike))
+    img = _open_image(source if is_path else io.BytesIO(source))
+    size = img.size
+    layout = _raw_pixel_layout(img)
+    if layout is not None:
+        # Uncompressed carriers are read straight from the file bytes instead of being decoded
+        buffer = np.memmap(source, dtype=np.uint8, mode="r") if is_path else np.frombuffer(source, dtype=np.uint8)
+        return _raw_views(buffer, img.width, layout), size
+    if pixel_count is not None:
+        img = _decode_rows(img, math.ceil(pixel_count / img.width)) or img
+    _check_decode(img)
+    # RGBA keeps its alpha channel in case the header says it carries data
+    return [np.asarray(_as_mode(img, "RGBA" if img.mode == "RGBA" else "RGB"))], size
+
+def _read_header(pixels, image_size):
+    # The header lives in the R, G, B channels of the first HEADER_PIXELS pixels; decode only those.
+    # Images without the magic are read as the bare sizes written before the versioned header:
+    # no flags, one bit per channel and no checksum
+    views = [_pixel_views(block)[0] for block in pixels]
+    data = _read_lsb_bytes(views, 0, HEADER_BYTES)
+    header = _unpack_header(data)
+    if header is not None:
+        header = _Header(*header, HEADER_BYTES)
+    elif len(data) >= LEGACY_HEADER_BYTES and _unpack_legacy_header(data) is not None:
+        header = _Header(*_unpack_legacy_header(data), 0, None, LEGACY_HEADER_BYTES)
+    else:
+        raise ValueError("Image does not contain a valid hidden file.")
+    
+    # Reject sizes the carrier could never hold before anything is allocated for them
+    if _channels_needed(_container_end(header), _flags_bpc(header.flags)) > _carrier_channels(*image_size, bool(header.flags & FLAG_ALPHA)):
+        raise ValueError("Image does not contain a valid hidden file.")
+    return header
+
+def _read_container(pixels, image_size, key=None):
+    header = _read_header(pixels, image_size)
+    size, ext_size, flags = header.size, header.ext_size, header.flags
+    bits_per_channel = _flags_bpc(flags)
+    
+    views = [_pixel_views(block)[0] for block in pixels]
+    if flags & FLAG_ALPHA:
+        block = pixels[0] if len(pixels) == 1 else np.concatenate(pixels)
+        if block.shape[-1] != 4:
+            # Encoders such as libwebp drop an alpha channel that no payload bit changed, it reads as opaque
+            block = np.concatenate([block, np.full(block.shape[:-1] + (1,), 255, dtype=np.uint8)], axis=-1)
+        views = _pixel_views(block, use_alpha=True)
+    
+    order = None
+    if flags & FLAG_SCATTER:
+        if key is None:
+            raise ValueError("Hidden file was scattered with a key, pass the key to extract it.")
+        order = _scatter_order(key, _carrier_channels(*image_size, bool(flags & FLAG_ALPHA)) - HEADER_BITS)
     
-    # Write the extracted file without a progress bar
-    with open(output_path, "wb") as f:
-        f.write(file_data)
+    offset = header.header_bytes + ext_size
+    shard = shard_id = None
+    if flags & FLAG_SHARDED:
+        shard, shard_id = _unpack_shard(_read_lsb_bytes(views, offset, _shard_bytes(flags), bits_per_channel, order))
+        offset += _shard_bytes(flags)
+    ext_bytes = _read_lsb_bytes(views, header.header_bytes, ext_size, bits_per_channel, order)
+    encryption = crc = None
+    if flags & FLAG_ENCRYPTED:
+        record = _read_lsb_bytes(views, offset, ENCRYPTION_BYTES, bits_per_channel, order)
+        encryption = (record, _encryption_ad(flags, ext_bytes, record))
+        offset += ENCRYPTION_BYTES
+    elif not flags & FLAG_FRAMED:
+        crc = header.crc  # Framed and encrypted payloads check each frame instead
+    
+    try:
+        ext = ext_bytes.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError(_corrupted_message(order)) from None
+    return _Container(views, size, ext, shard, shard_id, offset, bits_per_channel, _flags_codec(flags), crc, order, encryption, bool(flags & FLAG_FRAMED))
+
+def _read_payload(container, start, length):
+    return _read_lsb_bytes(container.views, container.offset + start, length, container.bits_per_channel, container.order)
+
+def _read_shard_record(image_path, key=None):
+    # Only the records before the payload are decoded, the payload is read when the stream reaches it
+    container = _load_container(image_path, key, payload=False)
+    if container.shard is None:
+        raise ValueError(f"{image_path} does not hold a shard of a file.")
+    return container.shard, (container.ext, container.codec, container.encryption, container.shard_id), image_path
+
+def _extract_sharded(image_paths, open_output, progress, key=None, passphrase=None):
+    # Shard records are read concurrently and the shards put in index order, whatever the input order
+    with ThreadPoolExecutor(max_workers=len(image_paths)) as executor:
+        shards = sorted(executor.map(functools.partial(_read_shard_record, key=key), image_paths), key=lambda shard: shard[0])
+    
+    if len({kind for _, kind, _ in shards}) != 1:
+        raise ValueError("Shards belong to different files.")
+    count = shards[0][0][1]
+    if [shard for shard, _, _ in shards] != [(index, count) for index in range(count)]:
+        raise ValueError("Images do not form a complete set of shards.")
+    
+    # Files were compressed and encrypted before being split, so the shards decrypt and decompress as one stream
+    ext, codec, encryption, _ = shards[0][1]
+    keys = None if encryption is None else _encryption_keys(passphrase, *encryption)
+    chunks = _iter_shard_payloads([path for _, _, path in shards], key, progress)
+    if keys is not None:
+        chunks = _iter_decrypted(chunks, keys)
+    _write_output(open_output, ext, _iter_decompressed(chunks, codec))
+    return ext
 
-    # Finalize extraction progress to 100% once the extraction is complete
-    _print_progress(total_pixels, total_pixels, "Extracting hidden data", 100)
+def _iter_shard_payloads(image_paths, key, progress):
+    # Checked payloads of the shards in order; the next image is decoded while this one is streamed,
+    # so at most two shards are held at a time
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(_load_container, image_paths[0], key)
+        for index in range(len(image_paths)):
+            container = pending.result()
+            if index + 1 < len(image_paths):
+                pending = executor.submit(_load_container, image_paths[index + 1], key)
+            yield from _iter_checked(container, None, _no_progress)
+            progress(index + 1, len(image_paths), "Extracting hidden data")
+
+@contextlib.contextmanager
+def _open_output(output_folder, ext):
+    # Written under a temporary name and renamed once every frame checked out,
+    # so a damaged file never leaves a truncated extracted_file behind
+    os.makedirs(output_folder, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=output_folder, prefix=".extracted_file.", delete=False)
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.remove(f.name)
+        raise
+    os.replace(f.name, os.path.join(output_folder, f"extracted_file.{ext}"))
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Extract a hidden file from an image.")
-    parser.add_argument('-i', '--image', required=True, help="The image with the hidden file.")
-    parser.add_argument('-o', '--output_folder', required=True, help="The folder to save the extracted file.")
+    parser.add_argument('-i', '--image', required=True, nargs='+', help="The image with the hidden file, or all images of a sharded file in any order.")
+    parser.add_argument('-o', '--output_folder', required=True, help="The folder to save the extracted file, or - to write it to stdout.")
+    parser.add_argument('-k', '--key', help="The key the file was hidden with.")
+    parser.add_argument('-e', '--encrypted', action='store_true', help=f"The file is encrypted, ask for the passphrase or take it from ${PASSPHRASE_ENV}.")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Do not print progress.")
     
     args = parser.parse_args()
-    extract(args.image, args.output_folder)
+    image = args.image[0] if len(args.image) == 1 else args.image
+    passphrase = prompt_passphrase() if args.encrypted else None
+    if args.output_folder == "-":
+        # Progress goes to stderr so it never mixes with the payload
+        extract_to(image, sys.stdout.buffer, progress=None if args.quiet else console_progress(sys.stderr), key=args.key, passphrase=passphrase)
+    else:
+        extract(image, args.output_folder, progress=None if args.quiet else console_progress(), key=args.key, passphrase=passphrase)
@@ -1,30 +1,283 @@
+import io
 import os
-from PIL import Image
-from steganography_utils import _read_file_bytes, validate_file_size, _get_size_info, _prepare_image, _embed_data_in_image, _print_progress
+import shutil
+import secrets
+import tempfile
+import contextlib
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from steganography_utils import STRIP_ROWS, HEADER_BYTES, SHARD_BYTES, FLAG_SHARDED, FLAG_SHARD_ID, FLAG_ALPHA, FLAG_SCATTER, FLAG_ENCRYPTED, FLAG_FRAMED, ALPHA_FORMATS, TIFF_COMPRESSIONS, MAX_BITS_PER_CHANNEL, PASSPHRASE_ENV, _bpc_flags, _validate_bits_per_channel, _validate_payload_size, _pack_header, _pack_shard, _crc32, _check_capacity, _image_capacity, _plan_shards, _as_mode, CODEC_NONE, COMPRESSION_CODECS, _codec_flags, _choose_codec, _compress_payload, _iter_buffer_chunks, _as_buffer, _output_format, _save_options, _check_lossless_output, _embed_chunks_in_image, _iter_file_chunks, _embed_in_strips, _is_raw_carrier, _raw_pixel_layout, _raw_views, _open_image, _check_decode, _embed_in_views, _embed_scattered, _container_size, _new_encryption, _encrypted_size, _iter_encrypted, _spool, _iter_framed, _framed_size, _unframed_capacity, pick_carrier, console_progress, prompt_passphrase
 
-def hide(file_path, image_path, output_path):
-    file_bytes = _read_file_bytes(file_path)
-    validate_file_size(file_bytes)
-    
+def hide(file_path, image_path, output_path, stream=False, strip_rows=STRIP_ROWS, progress=None, bits_per_channel=1, use_alpha=False, compression=None, workers=1,
+         compress_level=None, tiff_compression=None, fastest=False, key=None, passphrase=None, checksums=True):
+    # progress: optional callable(current, total, task_name), called once per chunk or strip
+    # stream: write PNG output strip_rows rows at a time; memory stays bounded by the strip size only for
+    # uncompressed BMP, PPM and TIFF carriers, other carriers are decoded in full first
+    # bits_per_channel: low bits of each channel used for the payload (1-4)
+    # use_alpha: also hide data in the alpha channel, the output is written as RGBA
+    # compression: None, "zlib", "bz2", "lzma", or "auto" to compress only when it pays off
+    # workers: threads writing row bands of the carrier in parallel
+    # compress_level: zlib level of PNG output (0-9), tiff_compression: one of TIFF_COMPRESSIONS,
+    # fastest: quickest lossless encoding of the output format, trading file size for speed
+    # key: str or bytes; spreads everything after the header over the carrier in an order derived
+    # from it, extract() then needs the same key
+    # passphrase: str or bytes; encrypts and authenticates the payload on its way into the carrier
+    # checksums: store a CRC32 every CHECKSUM_FRAME bytes, so damage is caught at the first bad frame
+    _validate_bits_per_channel(bits_per_channel)
+    encoder = dict(compress_level=compress_level, tiff_compression=tiff_compression, fastest=fastest)
+    options = dict(stream=stream, strip_rows=strip_rows, progress=progress, bits_per_channel=bits_per_channel, use_alpha=use_alpha, workers=workers, encoder=encoder, key=key)
+    if isinstance(image_path, (list, tuple)):
+        _hide_sharded(file_path, list(image_path), list(output_path), compression, passphrase, checksums, **options)
+        return
+
+    # Size the payload from os.stat; the file itself is only ever read chunk by chunk
+    ext = os.path.splitext(file_path)[1][1:]
+    read_file = functools.partial(_iter_file_chunks, file_path)
+    _hide_one(read_file, os.stat(file_path).st_size, ext, image_path, output_path, _output_format(output_path), compression, passphrase=passphrase, checksums=checksums, **options)
+
+def hide_bytes(payload, carrier, ext="", output_format="PNG", output=None, stream=False, strip_rows=STRIP_ROWS, progress=None, bits_per_channel=1, use_alpha=False, compression=None, workers=1,
+               compress_level=None, tiff_compression=None, fastest=False, key=None, passphrase=None, checksums=True):
+    # payload, carrier: bytes-like or binary file objects, ext: extension recorded for the payload
+    # Returns the encoded image as bytes, or writes it to the binary file object `output`
+    _validate_bits_per_channel(bits_per_channel)
+    encoder = dict(compress_level=compress_level, tiff_compression=tiff_compression, fastest=fastest)
+    options = dict(stream=stream, strip_rows=strip_rows, progress=progress, bits_per_channel=bits_per_channel, use_alpha=use_alpha, workers=workers, encoder=encoder, key=key)
+    payload = _as_buffer(payload)
+    carrier = carrier if hasattr(carrier, "read") else io.BytesIO(carrier)
+    buffer = io.BytesIO() if output is None else output
+
+    read_payload = functools.partial(_iter_buffer_chunks, payload)
+    _hide_one(read_payload, memoryview(payload).nbytes, ext, carrier, buffer, output_format.upper(), compression, in_memory=True, passphrase=passphrase, checksums=checksums, **options)
+    return buffer.getvalue() if output is None else None
+
+def _hide_one(read_file, file_size, ext, carrier, output, output_format, compression, in_memory=False, passphrase=None, checksums=True, **options):
+    # carrier: path or binary file object; output: path or binary file object written as output_format
+    # in_memory: the payload is already in memory, so a compressed copy may be kept there too
+    _check_output(output_format, options)
+
+    codec, size, read_payload = _open_payload(read_file, file_size, compression, in_memory)
+    ext_bytes = ext.encode('utf-8')
+
+    bits_per_channel, use_alpha = options["bits_per_channel"], options["use_alpha"]
+    flags = _container_flags(bits_per_channel, use_alpha, codec, options["key"], passphrase, checksums)
+    stored, record, crc = read_payload(), b"", 0
+    if passphrase is not None:
+        # Every frame carries its own tag, so the payload is encrypted as it is embedded
+        record, keys = _new_encryption(passphrase, flags, ext_bytes)
+        stored, size = _iter_encrypted(stored, keys), _encrypted_size(size, keys[2])
+    if checksums:
+        # Likewise every frame carries its own CRC
+        stored, size = _iter_framed(stored), _framed_size(size)
+    _validate_payload_size(size)
+
+    total = HEADER_BYTES + len(ext_bytes) + len(record) + size
+    img = _open_image(carrier)
+    _check_capacity(img.width, img.height, total, bits_per_channel, use_alpha)
+    if not checksums and passphrase is None:
+        # The checksum goes in the header, so it takes one extra pass over the payload, once the carrier is known to fit
+        crc = _crc32(read_payload())
+    prefix = _pack_header(size, len(ext_bytes), flags, crc) + ext_bytes + record
+    _embed_payload(img, carrier, output, output_format, itertools.chain([prefix], stored), total, **options)
+
+def _container_flags(bits_per_channel, use_alpha, codec, key=None, passphrase=None, checksums=False):
+    return (_bpc_flags(bits_per_channel) | (FLAG_ALPHA if use_alpha else 0) | _codec_flags(codec)
+            | (FLAG_SCATTER if key is not None else 0) | (FLAG_ENCRYPTED if passphrase is not None else 0)
+            | (FLAG_FRAMED if checksums else 0))
+
+def _open_payload(read_file, file_size, compression, in_memory=False):
+    # Returns (codec, stored size, read) where read(offset=0, length=None) yields the stored bytes
+    # chunk by chunk; read_file does the same for the original payload of file_size bytes
+    codec = _choose_codec(read_file, compression)
+    compressed = _compress_payload(read_file, file_size, codec, in_memory)
+    if compressed is None:
+        codec, size, read = CODEC_NONE, file_size, read_file
+    else:
+        size, read = len(compressed), functools.partial(_iter_buffer_chunks, compressed)
+    _validate_payload_size(size)
+    return codec, size, read
+
+def _check_output(output_format, options):
+    # Refuses outputs that cannot hold the data before any work is done
+    _check_lossless_output(output_format)
+    _save_options(output_format, **options["encoder"])
+    if options["stream"]:
+        _check_stream_output(output_format)
+        if options["key"] is not None:
+            raise ValueError("Streaming mode writes the carrier in order and cannot scatter the data with a key.")
+    if options["use_alpha"]:
+        _check_alpha_output(output_format)
+
+def _check_stream_output(output_format):
+    if output_format != "PNG":
+        raise ValueError("Streaming mode only supports PNG output.")
+
+def _check_alpha_output(output_format):
+    if output_format not in ALPHA_FORMATS:
+        raise ValueError("Alpha mode needs PNG, TIFF or WebP output.")
+
+def _embed_payload(img, carrier, output, output_format, chunks, total, *, stream, strip_rows, progress, bits_per_channel, use_alpha, workers, encoder, key):
+    _check_capacity(img.width, img.height, total, bits_per_channel, use_alpha)
+    save_options = _save_options(output_format, **encoder)
+    if stream:
+        # The carrier is still being read while the PNG is written, so it cannot be written over as it goes
+        with (_replacing(output) if _same_file(carrier, output) else contextlib.nullcontext(output)) as f:
+            _embed_in_strips(img, chunks, f, strip_rows, progress, bits_per_channel, use_alpha, save_options["compress_level"], carrier)
+        return
+
+    # The in-place path only rewrites the carrier's own R, G, B bytes, and works on uncompressed files only
+    in_place = not use_alpha and save_options.get("compression") in (None, "raw")
+    if in_place and isinstance(carrier, (str, os.PathLike)) and isinstance(output, (str, os.PathLike)) and _is_raw_carrier(img, output_format):
+        _hide_in_place(img, carrier, output, chunks, total, progress, bits_per_channel, workers, key)
+        return
+
+    _check_decode(img)
+    image = _as_mode(img, "RGBA" if use_alpha else "RGB")
+    encoded_image = _embed_chunks_in_image(image, chunks, total, progress, bits_per_channel, use_alpha, workers, key)
+    encoded_image.save(output, format=output_format, **save_options)
+
+def _hide_sharded(file_path, image_paths, output_paths, compression, passphrase=None, checksums=True, **options):
+    if len(image_paths) != len(output_paths):
+        raise ValueError("Need one output path per carrier image.")
+    output_formats = [_output_format(output_path) for output_path in output_paths]
+    for output_format in output_formats:
+        _check_output(output_format, options)
+
+    # The file is compressed as a whole and the compressed stream is what gets split
+    codec, file_size, read_payload = _open_payload(functools.partial(_iter_file_chunks, file_path), os.stat(file_path).st_size, compression)
     ext = os.path.splitext(file_path)[1][1:]
     ext_bytes = ext.encode('utf-8')
-    
-    size_info = _get_size_info(file_bytes, ext_bytes)
-    payload = size_info + ext_bytes + file_bytes
-    
-    img = Image.open(image_path)
-    image = _prepare_image(img, payload)
-    
-    encoded_image = _embed_data_in_image(image, payload)
-    encoded_image.save(output_path)
+    bits_per_channel, use_alpha = options["bits_per_channel"], options["use_alpha"]
+    flags = FLAG_SHARDED | FLAG_SHARD_ID | _container_flags(bits_per_channel, use_alpha, codec, options["key"], passphrase, checksums)
+
+    # Likewise the encrypted stream, spooled once so each shard can read its own slice of it
+    record = b""
+    if passphrase is not None:
+        record, keys = _new_encryption(passphrase, flags, ext_bytes)
+        encrypted = _spool(_iter_encrypted(read_payload(), keys))
+        file_size, read_payload = len(encrypted), functools.partial(_iter_buffer_chunks, encrypted)
+        _validate_payload_size(file_size)
+
+    # Every shard carries the header, the extension and its own shard record
+    images = [_open_image(image_path) for image_path in image_paths]
+    overhead = HEADER_BYTES + len(ext_bytes) + SHARD_BYTES + len(record)
+    capacities = []
+    for image_path, img in zip(image_paths, images):
+        capacity = _image_capacity(img.width, img.height, bits_per_channel, use_alpha)
+        if capacity < overhead:
+            raise ValueError(f"{image_path} is too small to hold a shard.")
+        capacities.append(capacity - overhead)
+    if checksums:
+        capacities = [_unframed_capacity(capacity) for capacity in capacities]
+    shard_sizes = _plan_shards(capacities, file_size)
+
+    # A random id in every shard record, so shards of different files are never put together
+    file_id = secrets.token_bytes(8)
+    jobs = []
+    offset = 0
+    for index, shard_size in enumerate(shard_sizes):
+        # Each shard is framed on its own, so it can be verified without the others
+        stored, stored_size, crc = read_payload(offset=offset, length=shard_size), shard_size, 0
+        if checksums:
+            stored, stored_size = _iter_framed(stored), _framed_size(shard_size)
+        elif passphrase is None:
+            crc = _crc32(read_payload(offset=offset, length=shard_size))
+        prefix = _pack_header(stored_size, len(ext_bytes), flags, crc) + ext_bytes + _pack_shard(index, len(images), file_id) + record
+        chunks = itertools.chain([prefix], stored)
+        jobs.append((images[index], image_paths[index], output_paths[index], output_formats[index], chunks, len(prefix) + stored_size))
+        offset += shard_size
+
+    # One worker per carrier; the PIL codecs and NumPy release the GIL
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(_embed_payload, *job, **options) for job in jobs]
+        for future in futures:
+            future.result()
+
+def _same_file(carrier, output):
+    # Paths naming the same existing file; file objects never are
+    paths = all(isinstance(path, (str, os.PathLike)) for path in (carrier, output))
+    return paths and os.path.exists(output) and os.path.samefile(carrier, output)
+
+@contextlib.contextmanager
+def _replacing(output_path):
+    # Binary file written next to output_path and moved over it once complete, removed on error
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output_path)), prefix=".hide.", delete=False)
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.remove(f.name)
+        raise
+    os.replace(f.name, output_path)
+
+def _hide_in_place(img, image_path, output_path, chunks, total, progress, bits_per_channel, workers, key=None):
+    # Uncompressed carriers: copy the file and flip LSBs through a memory map,
+    # so only the pages holding payload are ever read or written
+    layout = _raw_pixel_layout(img)
+    img.close()
+    # Hiding into the carrier itself edits it where it is
+    if not _same_file(image_path, output_path):
+        shutil.copyfile(image_path, output_path)
+
+    mapped = np.memmap(output_path, dtype=np.uint8, mode="r+")
+    views = _raw_views(mapped, img.width, layout)
+    if key is not None:
+        _embed_scattered(views, chunks, key, total, progress, bits_per_channel, workers)
+    else:
+        _embed_in_views(views, chunks, total=total, progress=progress, bits_per_channel=bits_per_channel, workers=workers)
+    mapped.flush()
 
 if __name__ == "__main__":
     import argparse
+    from steganography_catalog import update_catalog, pick_from_catalog, mark_used
 
     parser = argparse.ArgumentParser(description="Hide a file inside an image.")
     parser.add_argument('-f', '--file', required=True, help="The file to hide.")
-    parser.add_argument('-i', '--image', required=True, help="The image to embed the file into.")
-    parser.add_argument('-o', '--output', required=True, help="The output image with the hidden file.")
-    
+    parser.add_argument('-i', '--image', nargs='+', help="The image to embed the file into, or several images to shard it across.")
+    parser.add_argument('-o', '--output', required=True, nargs='+', help="The output image with the hidden file, one per input image.")
+    parser.add_argument('--pick', action='store_true', help="Hide in the smallest of the images that can hold the file instead of sharding across them.")
+    parser.add_argument('--carrier-pool', help="Directory of carrier images to pick the best fitting unused one from, instead of --image.")
+    parser.add_argument('--reuse-carriers', action='store_true', help="Let --carrier-pool pick carriers that already hid a file.")
+    parser.add_argument('--stream', action='store_true', help="Process the image in row strips and write PNG output as it goes; only uncompressed carriers are read strip by strip.")
+    parser.add_argument('--strip-rows', type=int, default=STRIP_ROWS, help="Rows per strip in streaming mode.")
+    parser.add_argument('-b', '--bits-per-channel', type=int, default=1, choices=range(1, MAX_BITS_PER_CHANNEL + 1), help="Low bits of each color channel to use for the data.")
+    parser.add_argument('-a', '--alpha', action='store_true', help="Also hide data in the alpha channel; the output is saved as RGBA.")
+    parser.add_argument('-z', '--compress', choices=["auto", *COMPRESSION_CODECS], default="none", help="Compress the file before hiding it; auto compresses only when it pays off.")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Threads writing row bands of the carrier in parallel.")
+    parser.add_argument('--png-compress-level', type=int, choices=range(10), help="zlib level for PNG output, lower is faster and larger.")
+    parser.add_argument('--tiff-compression', choices=TIFF_COMPRESSIONS, help="Lossless compression for TIFF output.")
+    parser.add_argument('--fastest', action='store_true', help="Use the quickest lossless encoding of the output format, the file gets larger.")
+    parser.add_argument('-k', '--key', help="Scatter the file over the whole image in an order derived from this key; extracting needs the same key.")
+    parser.add_argument('-e', '--encrypt', action='store_true', help=f"Encrypt the file with a passphrase, asked for or taken from ${PASSPHRASE_ENV}.")
+    parser.add_argument('--no-checksums', action='store_true', help="Store one CRC32 for the whole file instead of one per 64KB frame.")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Do not print progress.")
+
     args = parser.parse_args()
-    hide(args.file, args.image, args.output)
+    if bool(args.image) == bool(args.carrier_pool):
+        parser.error("Pass either --image or --carrier-pool.")
+    if (args.pick or args.carrier_pool) and len(args.output) != 1:
+        parser.error("--pick and --carrier-pool take a single output.")
+
+    passphrase = prompt_passphrase(confirm=True) if args.encrypt else None
+    progress = None if args.quiet else console_progress()
+    # Carriers are sized on the uncompressed file, so the pick holds even when compression does not pay off
+    ext = os.path.splitext(args.file)[1][1:]
+    file_size = os.stat(args.file).st_size
+    if args.carrier_pool:
+        catalog = update_catalog(args.carrier_pool)
+        entry = pick_from_catalog(catalog, _container_size(file_size, ext, args.encrypt, not args.no_checksums), args.bits_per_channel, args.alpha, args.reuse_carriers)
+        images, outputs = os.path.join(args.carrier_pool, entry["name"]), args.output[0]
+    elif args.pick:
+        images, outputs = pick_carrier(args.image, file_size, ext, args.bits_per_channel, args.alpha, args.encrypt, not args.no_checksums), args.output[0]
+    else:
+        images = args.image[0] if len(args.image) == 1 and len(args.output) == 1 else args.image
+        outputs = args.output[0] if len(args.image) == 1 and len(args.output) == 1 else args.output
+    if (args.pick or args.carrier_pool) and not args.quiet:
+        print(f"Using {images}")
+
+    hide(args.file, images, outputs, stream=args.stream, strip_rows=args.strip_rows, progress=progress,
+         bits_per_channel=args.bits_per_channel, use_alpha=args.alpha, compression=args.compress, workers=args.workers,
+         compress_level=args.png_compress_level, tiff_compression=args.tiff_compression, fastest=args.fastest, key=args.key, passphrase=passphrase, checksums=not args.no_checksums)
+    if args.carrier_pool:
+        mark_used(args.carrier_pool, catalog, entry)
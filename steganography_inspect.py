@@ -0,0 +1,89 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from steganography_utils import HEADER_PIXELS, UnsupportedVersionError, LEGACY_HEADER_BYTES, FLAG_ALPHA, FLAG_SCATTER, FLAG_ENCRYPTED, FLAG_FRAMED, COMPRESSION_CODECS, _flags_bpc, _flags_codec, _channels_needed, _pixels_needed, _image_capacity, _list_images
+from steganography_extract import _load_pixels, _read_header, _read_container, _payload_offset
+
+CODEC_NAMES = {codec: name for name, codec in COMPRESSION_CODECS.items()}
+INSPECT_BATCH = 256  # Images queued per worker thread at a time
+
+def inspect(image_path):
+    # Reports what an image carries from the header pixels alone, without touching the payload
+    try:
+        pixels, image_size = _load_pixels(image_path, pixel_count=HEADER_PIXELS)
+        header = _read_header(pixels, image_size)
+    except UnsupportedVersionError as e:
+        # Only the newer writer knows the rest of the header, but the file is there
+        return {"image": image_path, "hidden": True, "version": e.version, "error": str(e)}
+    except ValueError:
+        return {"image": image_path, "hidden": False}
+
+    # The extension and shard record follow the header; decode just far enough to cover them
+    flags = header.flags
+    bits_per_channel = _flags_bpc(flags)
+    use_alpha = bool(flags & FLAG_ALPHA)
+    prefix = _payload_offset(header)
+    ext = shard = shard_id = None
+    # Without the key the extension and shard record of a scattered file cannot be located
+    if not flags & FLAG_SCATTER:
+        pixels, image_size = _load_pixels(image_path, pixel_count=_pixels_needed(_channels_needed(prefix, bits_per_channel), use_alpha))
+        try:
+            container = _read_container(pixels, image_size)
+        except ValueError:
+            return {"image": image_path, "hidden": False}
+        ext, shard, shard_id = container.ext, container.shard, container.shard_id
+
+    capacity = _image_capacity(*image_size, bits_per_channel, use_alpha)
+    return {
+        "image": image_path,
+        "hidden": True,
+        "size": header.size,
+        "ext": ext,
+        "legacy": header.header_bytes == LEGACY_HEADER_BYTES,
+        "bits_per_channel": bits_per_channel,
+        "alpha": use_alpha,
+        "compression": CODEC_NAMES[_flags_codec(flags)],
+        "scattered": bool(flags & FLAG_SCATTER),
+        "encrypted": bool(flags & FLAG_ENCRYPTED),
+        "framed": bool(flags & FLAG_FRAMED),
+        "shard": list(shard) if shard else None,
+        "shard_id": shard_id.hex() if shard_id else None,
+        "crc32": None if header.crc is None or flags & (FLAG_ENCRYPTED | FLAG_FRAMED) else f"{header.crc:08x}",
+        "capacity": capacity,
+        "utilization": (prefix + header.size) / capacity,
+    }
+
+def inspect_many(paths, workers=None):
+    # Yields a report per image, in order; directories are expanded to the images they hold
+    yield from _map_images(_inspect_or_error, paths, workers)
+
+def _map_images(fn, paths, workers=None):
+    # fn(image_path) for every image of paths on a thread pool, results in order
+    image_paths = []
+    for path in paths:
+        image_paths.extend(_list_images(path) if os.path.isdir(path) else [path])
+    # Submit in batches so a directory of millions of images never queues millions of futures
+    workers = workers or os.cpu_count()
+    batch = workers * INSPECT_BATCH
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(image_paths), batch):
+            yield from executor.map(fn, image_paths[start:start + batch])
+
+def _inspect_or_error(image_path):
+    try:
+        return inspect(image_path)
+    except Exception as e:
+        return {"image": image_path, "error": str(e)}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check images for hidden files by reading only their header pixels.")
+    parser.add_argument('-i', '--image', required=True, nargs='+', help="Images or directories of images to inspect.")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="Number of worker threads.")
+    parser.add_argument('--hidden-only', action='store_true', help="Only report images that carry a hidden file.")
+
+    args = parser.parse_args()
+    for report in inspect_many(args.image, args.workers):
+        if report.get("hidden") or not args.hidden_only:
+            print(json.dumps(report), flush=True)
@@ -1,72 +1,954 @@
+import io
 import os
 import math
+import mmap
+import struct
+import bz2
+import lzma
+import zlib
+import hmac
+import hashlib
+import secrets
+import tempfile
+import contextlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
 
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+MAGIC = b"STG"
+FORMAT_VERSION = 1
+_HEADER_STRUCT = struct.Struct(">3sBHIHI")  # magic, version, flags, payload size, extension size, payload CRC32
+HEADER_BYTES = _HEADER_STRUCT.size
+_LEGACY_HEADER_STRUCT = struct.Struct(">II")  # payload size, extension size; written before the versioned header
+LEGACY_HEADER_BYTES = _LEGACY_HEADER_STRUCT.size
+MAX_EXT_BYTES = 255  # Longest extension a legacy header is trusted with
+_SHARD_STRUCT = struct.Struct(">HH8s")  # shard index, shard count, random id shared by the shards of one file
+SHARD_BYTES = _SHARD_STRUCT.size
+_LEGACY_SHARD_STRUCT = struct.Struct(">HH")  # shard index, shard count; written before shards carried a file id
+HEADER_BITS = HEADER_BYTES * 8  # The header always takes one bit per channel
+FLAG_SHARDED = 0x01  # A shard record follows the extension
+_FLAG_BPC_SHIFT = 1  # Flag bits 1-2 hold bits_per_channel - 1
+FLAG_ALPHA = 0x08  # The alpha channel carries data after the header pixels
+_FLAG_CODEC_SHIFT = 4  # Flag bits 4-5 hold the compression codec id
+FLAG_SCATTER = 0x40  # Channels after the header are visited in an order derived from a key
+FLAG_ENCRYPTED = 0x80  # An encryption record follows the extension and shard record
+_ENCRYPTION_STRUCT = struct.Struct(">BBBB16s")  # scrypt log2 N, r, p, log2 frame size, salt
+ENCRYPTION_BYTES = _ENCRYPTION_STRUCT.size
+SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P = 15, 8, 1  # 32MB and about a tenth of a second per derivation
+MAX_SCRYPT_MEMORY = 256 * 1024 * 1024  # Records asking scrypt for more (128 * r * N bytes) are refused
+MAX_SCRYPT_P = 4  # p multiplies the CPU cost, records asking for more are refused
+ENCRYPTION_FRAME_LOG2 = 16  # 64KB of payload per authenticated frame
+TAG_BYTES = 16
+FLAG_FRAMED = 0x100  # The stored payload is split into frames that each end in their own CRC32
+FLAG_SHARD_ID = 0x200  # The shard record carries the file id
+CHECKSUM_FRAME = 64 * 1024  # Stored bytes per checksummed frame, fixed by the format
+CRC_BYTES = 4
+PASSPHRASE_ENV = "STEGANOGRAPHY_PASSPHRASE"  # Read by the command line tools instead of prompting
+CODEC_NONE, CODEC_ZLIB, CODEC_BZ2, CODEC_LZMA = range(4)
+COMPRESSION_CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "bz2": CODEC_BZ2, "lzma": CODEC_LZMA}
+COMPRESSION_SAMPLE_SIZE = 256 * 1024  # Bytes compressed up front to decide whether "auto" compresses
+MIN_COMPRESSION_SAVING = 0.1  # "auto" only compresses when the sample shrinks by at least this much
+MAX_BITS_PER_CHANNEL = 4
+MAX_FILE_SIZE = 2 ** 32 - 1  # Largest size the 32-bit header field can record
+HEADER_PIXELS = math.ceil(HEADER_BYTES * 8 / 3)
+STRIP_ROWS = 256  # Rows per strip in streaming mode
+PAYLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+BAND_CHANNELS = 2 * 1024 * 1024  # Channels per band handed to a worker thread in parallel mode
+RAW_FORMATS = ("BMP", "PPM", "TIFF")  # Formats that may store pixels uncompressed
+_OPEN_LOCK = threading.Lock()  # Guards the swap of Image.MAX_IMAGE_PIXELS in _open_image
+ALPHA_FORMATS = ("PNG", "TIFF", "WEBP")  # Formats PIL writes and reads back with a full alpha channel
+LOSSLESS_FORMATS = ("PNG", "BMP", "PPM", "TIFF", "WEBP")  # Output formats known to keep every low bit; WebP is always written lossless
+TIFF_COMPRESSIONS = ("raw", "tiff_lzw", "tiff_deflate", "tiff_adobe_deflate", "packbits")  # Lossless TIFF codecs
+DEFAULT_COMPRESS_LEVEL = 6  # zlib level PIL uses for PNG by default
+TOP_DOWN_DECODERS = ("zip", "raw")  # PIL decoders that fill rows top to bottom and stop early
+SCATTER_ROUNDS = 6  # Feistel rounds of the keyed channel order
+_SCATTER_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)  # Odd constant of the Feistel round function
 
 def _read_file_bytes(path):
     with open(path, "rb") as f:
         return f.read()
 
+def _iter_file_chunks(path, chunk_size=PAYLOAD_CHUNK_SIZE, offset=0, length=None):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+def _as_buffer(data):
+    # bytes-like objects pass through, binary file objects are read in full
+    if hasattr(data, "getvalue"):
+        return data.getvalue()
+    if hasattr(data, "read"):
+        return data.read()
+    return data
+
+def _open_for_write(output):
+    # Output path or an already open binary file object, which is left open
+    if hasattr(output, "write"):
+        return contextlib.nullcontext(output)
+    return open(output, "wb")
+
+def _save_options(output_format, compress_level=None, tiff_compression=None, fastest=False):
+    # Keyword arguments for Image.save; fastest picks the quickest lossless encoding of each format
+    if output_format == "PNG":
+        if compress_level is None:
+            compress_level = 0 if fastest else DEFAULT_COMPRESS_LEVEL
+        return {"compress_level": compress_level, "optimize": False}
+    if output_format == "TIFF":
+        compression = tiff_compression or ("raw" if fastest else None)
+        if compression is not None and compression not in TIFF_COMPRESSIONS:
+            raise ValueError(f"TIFF compression must be one of {', '.join(TIFF_COMPRESSIONS)}.")
+        return {"compression": compression} if compression else {}
+    if output_format == "WEBP":
+        # WebP is only ever written lossless, exact keeps the colour of fully transparent pixels
+        return {"lossless": True, "exact": True, "method": 0 if fastest else 4}
+    return {}
+
+def _check_lossless_output(output_format):
+    if output_format not in LOSSLESS_FORMATS:
+        raise ValueError(f"{output_format or 'This'} output is not known to be lossless and could destroy the hidden data, use one of {', '.join(LOSSLESS_FORMATS)}.")
+
+def _list_images(directory):
+    image_exts = Image.registered_extensions()
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[1].lower() in image_exts
+    )
+
+def _output_format(output_path):
+    return Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+
+def _iter_buffer_chunks(buffer, chunk_size=PAYLOAD_CHUNK_SIZE, offset=0, length=None):
+    # Zero-copy slices of a bytes-like object, safe to use from several threads at once
+    view = memoryview(buffer)
+    stop = len(view) if length is None else min(offset + length, len(view))
+    for start in range(offset, stop, chunk_size):
+        yield view[start:min(start + chunk_size, stop)]
+
 def validate_file_size(data):
-    if len(data) > MAX_FILE_SIZE:
+    _validate_payload_size(len(data))
+
+def _validate_payload_size(size):
+    if size > MAX_FILE_SIZE:
         raise ValueError("File too large to embed.")
 
+def _pack_header(size, ext_size, flags=0, crc=0):
+    return _HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, flags, size, ext_size, crc)
+
+class UnsupportedVersionError(ValueError):
+    # The image does carry a hidden file, written by a newer version of the format
+    def __init__(self, version):
+        super().__init__(f"Hidden file uses format version {version}, only versions up to {FORMAT_VERSION} are supported.")
+        self.version = version
+
+def _unpack_header(data):
+    # Returns (size, ext_size, flags, crc), or None when data does not start with the magic
+    if len(data) < HEADER_BYTES or not data.startswith(MAGIC):
+        return None
+    _, version, flags, size, ext_size, crc = _HEADER_STRUCT.unpack_from(data)
+    if version > FORMAT_VERSION:
+        raise UnsupportedVersionError(version)
+    return size, ext_size, flags, crc
+
+def _unpack_legacy_header(data):
+    # Returns (size, ext_size) of a pre-versioned header, or None when it cannot be one
+    size, ext_size = _LEGACY_HEADER_STRUCT.unpack_from(data)
+    # All-zero low bits, as in flat or synthetic images, would otherwise read as an empty file
+    if size == 0 or ext_size > MAX_EXT_BYTES:
+        return None
+    return size, ext_size
+
+def _crc32(chunks):
+    crc = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _bpc_flags(bits_per_channel):
+    return (bits_per_channel - 1) << _FLAG_BPC_SHIFT
+
+def _flags_bpc(flags):
+    return (flags >> _FLAG_BPC_SHIFT & 0x03) + 1
+
+def _validate_bits_per_channel(bits_per_channel):
+    if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL:
+        raise ValueError(f"bits_per_channel must be between 1 and {MAX_BITS_PER_CHANNEL}.")
+
+def _codec_flags(codec):
+    return codec << _FLAG_CODEC_SHIFT
+
+def _flags_codec(flags):
+    return flags >> _FLAG_CODEC_SHIFT & 0x03
+
+def _compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(9)
+    if codec == CODEC_BZ2:
+        return bz2.BZ2Compressor()
+    return lzma.LZMACompressor()
+
+def _decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_BZ2:
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+def _choose_codec(read, compression):
+    # read(offset=0, length=None) yields the payload chunk by chunk
+    # compression: None, a COMPRESSION_CODECS name, or "auto" to use zlib when a sample of the payload shrinks enough
+    if compression is None:
+        return CODEC_NONE
+    if compression != "auto":
+        if compression not in COMPRESSION_CODECS:
+            raise ValueError(f"Unknown compression {compression!r}.")
+        return COMPRESSION_CODECS[compression]
+    
+    sample = next(read(length=COMPRESSION_SAMPLE_SIZE), b"")
+    if len(zlib.compress(sample, 6)) > len(sample) * (1 - MIN_COMPRESSION_SAVING):
+        return CODEC_NONE
+    return CODEC_ZLIB
+
+def _compress_payload(read, size, codec, in_memory=False):
+    # Compresses chunk by chunk into a temporary file and returns a read-only memory map of it,
+    # or into memory when the payload is already held there; None when compressing does not
+    # make the `size` byte payload smaller
+    if codec == CODEC_NONE:
+        return None
+    compressor = _compressor(codec)
+    with (io.BytesIO() if in_memory else tempfile.TemporaryFile()) as out:
+        for chunk in read():
+            out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+        out.flush()
+        if out.tell() >= size:
+            return None
+        if in_memory:
+            return out.getvalue()
+        # The mapping stays valid after the temporary file is closed
+        return mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _iter_decompressed(chunks, codec):
+    # Decompresses a stream of chunks as they arrive, so the payload is never held whole
+    if codec == CODEC_NONE:
+        yield from chunks
+        return
+    decompressor = _decompressor(codec)
+    try:
+        for chunk in chunks:
+            yield from _iter_drained(decompressor, chunk)
+        if codec == CODEC_ZLIB:
+            yield decompressor.flush()
+    # bz2 and lzma raise EOFError for data past the end of the stream
+    except (zlib.error, OSError, lzma.LZMAError, EOFError):
+        raise ValueError("Hidden file is corrupted.") from None
+    # Bytes left over after the end of the stream arrived in the same chunk as its end
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError("Hidden file is corrupted.")
+
+def _iter_drained(decompressor, data):
+    # Output of one compressed chunk at most PAYLOAD_CHUNK_SIZE bytes at a time,
+    # a chunk of a highly compressible file could otherwise expand without limit
+    while True:
+        if hasattr(decompressor, "unconsumed_tail"):
+            # zlib hands back the input it did not get to; a full output may still have more pending
+            out = decompressor.decompress(data, PAYLOAD_CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+            more = bool(data) or len(out) == PAYLOAD_CHUNK_SIZE
+        else:
+            # bz2 and lzma keep unconsumed input buffered and ask for more once it is used up
+            out = decompressor.decompress(data, max_length=PAYLOAD_CHUNK_SIZE)
+            data = b""
+            more = not decompressor.needs_input and not decompressor.eof
+        if out:
+            yield out
+        if not more:
+            return
+
+def _new_encryption(passphrase, flags, ext_bytes):
+    # Returns (record, keys) for a fresh random salt; the record goes into the container
+    record = _ENCRYPTION_STRUCT.pack(SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P, ENCRYPTION_FRAME_LOG2, secrets.token_bytes(16))
+    return record, _encryption_keys(passphrase, record, _encryption_ad(flags, ext_bytes, record))
+
+def _encryption_ad(flags, ext_bytes, record):
+    # Associated data of every frame tag: the container fields every shard of a file shares, so the
+    # flags, extension and record cannot be swapped. Sizes and shard records differ between shards
+    # and are covered by the frame numbers and the final marker instead
+    return struct.pack(">HH", flags, len(ext_bytes)) + ext_bytes + record
+
+def _encryption_keys(passphrase, record, ad=b""):
+    # keys: (stream key, MAC key, frame size, associated data), derived with the scrypt parameters of the record
+    if passphrase is None:
+        raise ValueError("Hidden file is encrypted, pass the passphrase to extract it.")
+    log2_n, r, p, log2_frame, salt = _ENCRYPTION_STRUCT.unpack_from(record)
+    n = 1 << log2_n
+    # The record comes from the image, so a crafted one must not make extraction allocate gigabytes
+    if not (1 <= log2_n and 1 <= r and 128 * r * n <= MAX_SCRYPT_MEMORY and 1 <= p <= MAX_SCRYPT_P and 10 <= log2_frame <= 24):
+        raise ValueError("Hidden file is corrupted.")
+    key = hashlib.scrypt(_key_bytes(passphrase), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p), dklen=64)
+    return key[:32], key[32:], 1 << log2_frame, ad
+
+def _encrypted_size(size, frame_size=1 << ENCRYPTION_FRAME_LOG2):
+    # Every frame carries a tag, and even an empty payload has one frame
+    return size + max(math.ceil(size / frame_size), 1) * TAG_BYTES
+
+def _iter_frames(chunks, frame_size):
+    # Chunks of any size -> frame_size pieces, the last one may be shorter
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        while len(pending) - start >= frame_size:
+            yield bytes(pending[start:start + frame_size])
+            start += frame_size
+        del pending[:start]
+    if pending:
+        yield bytes(pending)
+
+def _iter_last(items):
+    # Yields (item, is_last) pairs, always at least one: (b"", True) for no items
+    previous = None
+    for item in items:
+        if previous is not None:
+            yield previous, False
+        previous = item
+    yield (b"" if previous is None else previous), True
+
+def _frame_cipher(keys, index, final, data):
+    # The frame number and the final marker go into both the keystream and the tag, so frames
+    # cannot be reordered, dropped or cut off at the end without the tags failing
+    nonce = struct.pack(">QB", index, final)
+    keystream = hashlib.shake_256(keys[0] + nonce).digest(len(data))
+    return nonce, np.bitwise_xor(np.frombuffer(data, dtype=np.uint8), np.frombuffer(keystream, dtype=np.uint8)).tobytes()
+
+def _frame_tag(keys, nonce, ciphertext):
+    ad = keys[3]
+    return hashlib.blake2b(struct.pack(">I", len(ad)) + ad + nonce + ciphertext, key=keys[1], digest_size=TAG_BYTES).digest()
+
+def _iter_encrypted(chunks, keys):
+    # Plaintext chunks -> ciphertext frames each followed by its tag, one frame in memory at a time
+    for index, (frame, final) in enumerate(_iter_last(_iter_frames(chunks, keys[2]))):
+        nonce, ciphertext = _frame_cipher(keys, index, final, frame)
+        yield ciphertext + _frame_tag(keys, nonce, ciphertext)
+
+def _iter_decrypted(chunks, keys):
+    # Stored chunks -> plaintext, every frame is checked before any of it is yielded
+    for index, (frame, final) in enumerate(_iter_last(_iter_frames(chunks, keys[2] + TAG_BYTES))):
+        ciphertext, tag = frame[:-TAG_BYTES], frame[-TAG_BYTES:]
+        nonce = struct.pack(">QB", index, final)
+        if len(frame) < TAG_BYTES or not hmac.compare_digest(tag, _frame_tag(keys, nonce, ciphertext)):
+            raise ValueError("Hidden file is corrupted or the passphrase is wrong.")
+        yield _frame_cipher(keys, index, final, ciphertext)[1]
+
+def _framed_size(size):
+    return size + math.ceil(size / CHECKSUM_FRAME) * CRC_BYTES
+
+def _unframed_capacity(capacity):
+    # Most payload bytes whose framed form fits in `capacity` bytes
+    return max(capacity - math.ceil(capacity / (CHECKSUM_FRAME + CRC_BYTES)) * CRC_BYTES, 0)
+
+def _frame_crc(index, frame):
+    # The frame number is folded in, so frames that trade places do not pass
+    return zlib.crc32(frame, zlib.crc32(index.to_bytes(8, "big")))
+
+def _iter_framed(chunks):
+    # Stored chunks -> frames each followed by their CRC32
+    for index, frame in enumerate(_iter_frames(chunks, CHECKSUM_FRAME)):
+        yield frame + _frame_crc(index, frame).to_bytes(CRC_BYTES, "big")
+
+def _iter_unframed(chunks):
+    # Framed chunks -> stored bytes, stopping at the first frame whose CRC does not match
+    for index, frame in enumerate(_iter_frames(chunks, CHECKSUM_FRAME + CRC_BYTES)):
+        data, crc = frame[:-CRC_BYTES], frame[-CRC_BYTES:]
+        if len(frame) <= CRC_BYTES or _frame_crc(index, data).to_bytes(CRC_BYTES, "big") != crc:
+            raise ValueError(f"Hidden file is corrupted at byte {index * CHECKSUM_FRAME}.")
+        yield data
+
+def _spool(chunks):
+    # Writes chunks to a temporary file and returns a read-only memory map of it
+    with tempfile.TemporaryFile() as out:
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+        return mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _shard_bytes(flags):
+    # Size of the shard record the flags announce, 0 for a whole file
+    if not flags & FLAG_SHARDED:
+        return 0
+    return SHARD_BYTES if flags & FLAG_SHARD_ID else _LEGACY_SHARD_STRUCT.size
+
+def _pack_shard(index, count, file_id):
+    return _SHARD_STRUCT.pack(index, count, file_id)
+
+def _unpack_shard(data):
+    # Returns ((index, count), file id), the id is None for records written without one
+    if len(data) == SHARD_BYTES:
+        index, count, file_id = _SHARD_STRUCT.unpack_from(data)
+        return (index, count), file_id
+    return _LEGACY_SHARD_STRUCT.unpack_from(data), None
+
+def _unpack_bits(data):
+    # bytes / bytearray / memoryview -> uint8 array of 0/1, MSB first
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+def _pack_bits(bits):
+    # uint8 array of 0/1, MSB first -> bytes
+    return np.packbits(bits).tobytes()
+
+# Compatibility shim writing the legacy header, prefer _pack_header
 def _get_size_info(file_bytes, ext_bytes):
-    size_bits = format(len(file_bytes), '032b')
-    ext_size_bits = format(len(ext_bytes), '032b')
-    return _bits_to_bytes(size_bits + ext_size_bits)
-
-def _prepare_image(img, payload):
-    img = img.convert("RGB")
-    required_pixels = math.ceil(len(payload) * 8 / 3)
-    if img.width * img.height < required_pixels:
+    return _LEGACY_HEADER_STRUCT.pack(len(file_bytes), len(ext_bytes))
+
+def _channels_needed(payload_size, bits_per_channel=1):
+    # Channels covering the header at one bit each plus the rest at bits_per_channel each
+    return HEADER_BITS + math.ceil((payload_size - HEADER_BYTES) * 8 / bits_per_channel)
+
+def _carrier_channels(width, height, use_alpha=False):
+    # The header pixels only ever use R, G and B, so they read the same with or without alpha
+    if use_alpha:
+        return width * height * 4 - min(HEADER_PIXELS, width * height)
+    return width * height * 3
+
+def _pixels_needed(channels, use_alpha=False):
+    # Pixels from the top-left that cover the first `channels` carrier channels
+    if use_alpha:
+        return HEADER_PIXELS + math.ceil(max(channels - HEADER_PIXELS * 3, 0) / 4)
+    return math.ceil(channels / 3)
+
+def _image_capacity(width, height, bits_per_channel=1, use_alpha=False):
+    # Bytes that fit in the low bits of the carrier channels
+    channels = _carrier_channels(width, height, use_alpha)
+    if channels < HEADER_BITS:
+        return 0  # Not even the header fits
+    return HEADER_BYTES + (channels - HEADER_BITS) * bits_per_channel // 8
+
+def _check_capacity(width, height, payload_size, bits_per_channel=1, use_alpha=False):
+    if payload_size > _image_capacity(width, height, bits_per_channel, use_alpha):
         raise ValueError("Image not large enough to hold the data.")
-    return img
 
-def _embed_data_in_image(image, data):
-    flat_data_bits = ''.join(format(byte, '08b') for byte in data)
-    pixels = list(image.getdata())
-    
-    new_pixels = []
-    bit_index = 0
-    last_progress = -1  # Track the last progress percentage
-    
-    for idx, pixel in enumerate(pixels):
-        new_pixel = []
-        for channel in pixel[:3]:  # R, G, B
-            if bit_index < len(flat_data_bits):
-                channel = (channel & ~1) | int(flat_data_bits[bit_index])
-                bit_index += 1
-            new_pixel.append(channel)
-        
-        new_pixels.append(tuple(new_pixel + list(pixel[3:])))  # Handle alpha if exists
-        
-        # Calculate the progress percentage
-        percent = (idx + 1) / len(pixels) * 100
-        percent = int(percent // 5 * 5)  # Round to nearest multiple of 5
-        
-        # Print progress only if the percentage has moved by 5%
-        if percent > last_progress:
-            _print_progress(idx + 1, len(pixels), "Embedding data in image", percent)
-            last_progress = percent
-    
-    image.putdata(new_pixels)
+def _plan_shards(capacities, total):
+    # Split `total` bytes across carriers in proportion to their capacity,
+    # so the carriers take roughly the same time to embed
+    if total > sum(capacities):
+        raise ValueError("Images not large enough to hold the data.")
+    sizes = [total * capacity // max(sum(capacities), 1) for capacity in capacities]
+    
+    # Hand out the rounding remainder to carriers that still have room
+    remainder = total - sum(sizes)
+    for index, capacity in enumerate(capacities):
+        extra = min(remainder, capacity - sizes[index])
+        sizes[index] += extra
+        remainder -= extra
+    return sizes
+
+def _as_mode(img, mode):
+    # Skips the full-image conversion copy when the image is already in `mode`
+    return img if img.mode == mode else img.convert(mode)
+
+def _prepare_image(img, payload, use_alpha=False):
+    # The size is known from the header, so a carrier that is too small is rejected before decoding
+    _check_capacity(img.width, img.height, len(payload), use_alpha=use_alpha)
+    return _as_mode(img, "RGBA" if use_alpha else "RGB")
+
+def _container_size(payload_size, ext="", encrypted=False, checksums=True):
+    # Bytes a single-carrier container takes: header, extension and payload,
+    # plus the encryption record and frame tags when encrypted and the frame CRCs with checksums
+    record = 0
+    if encrypted:
+        record, payload_size = ENCRYPTION_BYTES, _encrypted_size(payload_size)
+    if checksums:
+        payload_size = _framed_size(payload_size)
+    return HEADER_BYTES + len(ext.encode('utf-8')) + record + payload_size
+
+def carrier_capacity(image_path, bits_per_channel=1, use_alpha=False):
+    # Bytes of container a carrier can hold, from the dimensions in its header; no pixels are decoded
+    with _open_image(image_path) as img:
+        return _image_capacity(img.width, img.height, bits_per_channel, use_alpha)
+
+def pick_carrier(image_paths, payload_size, ext="", bits_per_channel=1, use_alpha=False, encrypted=False, checksums=True):
+    # Smallest carrier that can hold a payload_size byte file with extension ext;
+    # files PIL cannot identify are skipped
+    needed = _container_size(payload_size, ext, encrypted, checksums)
+    candidates = []
+    for image_path in image_paths:
+        try:
+            capacity = carrier_capacity(image_path, bits_per_channel, use_alpha)
+        except OSError:
+            continue
+        if capacity >= needed:
+            candidates.append((capacity, image_path))
+    if not candidates:
+        raise ValueError("No image large enough to hold the data.")
+    return min(candidates)[1]
+
+def _pixel_views(pixels, first_pixel=0, use_alpha=False):
+    # Views of a block of pixels, starting at pixel number first_pixel, in channel order:
+    # R, G, B everywhere, plus A after the header pixels when the alpha channel carries data
+    if not use_alpha:
+        return [pixels[..., :3]]
+    px = pixels.reshape(-1, 4)
+    header = min(max(HEADER_PIXELS - first_pixel, 0), len(px))
+    return [px[:header, :3], px[header:]]
+
+def _embed_bits(flat, bits):
+    # Clear the LSB of every channel that carries a bit and write the bit in
+    flat[:bits.size] = (flat[:bits.size] & 0xFE) | bits
+
+def _group_bits(bits, bits_per_channel):
+    # 0/1 array -> one value of bits_per_channel bits per channel, MSB first
+    if bits_per_channel == 1:
+        return bits
+    grouped = bits.reshape(-1, bits_per_channel)
+    values = grouped[:, 0].copy()
+    for column in range(1, bits_per_channel):
+        values <<= 1
+        values |= grouped[:, column]
+    return values
+
+def _ungroup_bits(values, bits_per_channel):
+    # Channel values -> their low bits_per_channel bits as a 0/1 array, MSB first
+    if bits_per_channel == 1:
+        return values & 1
+    return np.unpackbits(values[:, None], axis=1)[:, 8 - bits_per_channel:].reshape(-1)
+
+def _iter_channel_values(chunks, bits_per_channel=1):
+    # Payload chunks -> arrays of values to write into consecutive channels:
+    # the header one bit per channel, everything after it bits_per_channel per channel
+    bit_chunks = (_unpack_bits(chunk) for chunk in chunks)
+    header_bits, pending = _take_bits(bit_chunks, np.empty(0, dtype=np.uint8), HEADER_BITS)
+    yield header_bits
+    
+    carry = pending
+    for bits in bit_chunks:
+        if carry.size:
+            bits = np.concatenate([carry, bits])
+        usable = bits.size - bits.size % bits_per_channel
+        carry = bits[usable:]
+        if usable:
+            yield _group_bits(bits[:usable], bits_per_channel)
+    if carry.size:
+        padding = np.zeros(-carry.size % bits_per_channel, dtype=np.uint8)
+        yield _group_bits(np.concatenate([carry, padding]), bits_per_channel)
+
+def _write_channels(flat, values, start, bits_per_channel=1):
+    # Write values into flat, whose first element is channel number `start`
+    header = min(max(HEADER_BITS - start, 0), values.size)
+    _embed_bits(flat, values[:header])
+    if values.size > header:
+        keep = 0xFF ^ ((1 << bits_per_channel) - 1)
+        flat[header:values.size] = (flat[header:values.size] & keep) | values[header:]
+
+def _write_view(view, values, channel, bits_per_channel=1):
+    # Write values into a possibly strided view whose first element is channel number `channel`
+    cells = view.copy()  # Contiguous, so it can be written in channel order
+    _write_channels(cells.reshape(-1), values, channel, bits_per_channel)
+    view[...] = cells
+
+def _embed_data_in_image(image, data, progress=None, bits_per_channel=1, use_alpha=False, workers=1, key=None):
+    return _embed_chunks_in_image(image, [data], len(data), progress, bits_per_channel, use_alpha, workers, key)
+
+def _embed_chunks_in_image(image, chunks, total=None, progress=None, bits_per_channel=1, use_alpha=False, workers=1, key=None):
+    # workers > 1 writes row bands on that many threads
+    # key: scatter the channels after the header in the order derived from it
+    progress = progress or _no_progress
+    pixels = np.array(image, dtype=np.uint8)  # Writable copy of the raster
+    
+    if key is not None:
+        _embed_scattered(_pixel_views(pixels, use_alpha=use_alpha), chunks, key, total, progress, bits_per_channel, workers)
+        image.frombytes(pixels)
+        return image
+    
+    if use_alpha:
+        _embed_in_views(_pixel_views(pixels, use_alpha=True), chunks, STRIP_ROWS * image.width,
+                        total, progress, bits_per_channel, workers)
+        image.frombytes(pixels)
+        return image
+    
+    flat = pixels.reshape(-1)  # R, G, B, R, G, B, ...
+    total_channels = _channels_needed(total, bits_per_channel) if total else flat.size
+    
+    # Every band covers its own channel range, so bands can be written in any order
+    channel = 0
+    with _BandPool(workers) as pool:
+        for values in _iter_channel_values(chunks, bits_per_channel):
+            for start in range(0, values.size, BAND_CHANNELS):
+                band = values[start:start + BAND_CHANNELS]
+                pool.submit(_write_channels, flat[channel:channel + band.size], band, channel, bits_per_channel)
+                channel += band.size
+            progress(channel, total_channels, "Embedding data in image")
+    
+    image.frombytes(pixels)
     return image
 
+class _BandPool:
+    # Runs band writes on worker threads, NumPy releases the GIL inside the bitwise ops.
+    # At most two bands per worker are queued, so only a few chunks of payload bits are alive at a time
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._pending = deque()
+        self._limit = 2 * workers
+    
+    def submit(self, fn, *args):
+        if self._executor is None:
+            fn(*args)
+            return
+        if len(self._pending) >= self._limit:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(fn, *args))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+def _key_bytes(key):
+    return key.encode('utf-8') if isinstance(key, str) else bytes(key)
+
+def _scatter_order(key, count):
+    # Keyed bijection of [0, count) evaluated on whole index arrays: a Feistel network over the
+    # next even power of two, results past count are walked through it again until they land inside.
+    # Positions are computed for just the indices asked for, no permutation table is ever built
+    half = max(((count - 1).bit_length() + 1) // 2, 1)
+    digest = hashlib.blake2b(_key_bytes(key) + count.to_bytes(8, "big"), digest_size=8 * SCATTER_ROUNDS).digest()
+    round_keys = np.frombuffer(digest, dtype=">u8").astype(np.uint64)
+    mask, shift, top = np.uint64((1 << half) - 1), np.uint64(half), np.uint64(64 - half)
+    
+    def permute(x):
+        left, right = x >> shift, x & mask
+        for round_key in round_keys:
+            left, right = right, left ^ (((right ^ round_key) * _SCATTER_MULTIPLIER) >> top)
+        return left << shift | right
+    
+    def order(indices):
+        positions = permute(indices.astype(np.uint64))
+        outside = np.flatnonzero(positions >= count)
+        while outside.size:
+            positions[outside] = permute(positions[outside])
+            outside = outside[positions[outside] >= count]
+        return positions.astype(np.int64)
+    
+    return order
+
+def _locate_channels(views, channels):
+    # Yields (view, positions in channels, index into view) for every view holding some of the channels
+    base = 0
+    for view in views:
+        inside = np.flatnonzero((channels >= base) & (channels < base + view.size))
+        if inside.size:
+            yield view, inside, np.unravel_index(channels[inside] - base, view.shape)
+        base += view.size
+
+def _gather_channels(views, channels):
+    values = np.empty(channels.size, dtype=np.uint8)
+    for view, inside, index in _locate_channels(views, channels):
+        values[inside] = view[index]
+    return values
+
+def _put_channels(views, channels, values, bits_per_channel=1):
+    keep = 0xFF ^ ((1 << bits_per_channel) - 1)
+    for view, inside, index in _locate_channels(views, channels):
+        view[index] = (view[index] & keep) | values[inside]
+
+def _put_scattered(views, order, first, values, bits_per_channel):
+    # values go to data channels first, first + 1, ... wherever the order puts them
+    _put_channels(views, HEADER_BITS + order(np.arange(first, first + values.size)), values, bits_per_channel)
+
+def _gather_scattered(views, order, first, last):
+    # Values of data channels [first, last), a band of positions at a time
+    parts = [_gather_channels(views, HEADER_BITS + order(np.arange(lo, min(lo + BAND_CHANNELS, last))))
+             for lo in range(first, last, BAND_CHANNELS)]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.uint8)
+
+def _embed_scattered(views, chunks, key, total=None, progress=None, bits_per_channel=1, workers=1):
+    # The header takes the first channels as usual so it can be found without the key; every
+    # later value goes to the channel the key gives it. Only channels carrying data are touched
+    progress = progress or _no_progress
+    carrier_channels = sum(view.size for view in views)
+    total_channels = _channels_needed(total, bits_per_channel) if total else carrier_channels
+    order = _scatter_order(key, carrier_channels - HEADER_BITS)
+    value_chunks = _iter_channel_values(chunks, bits_per_channel)
+    header = next(value_chunks)
+    _put_channels(views, np.arange(header.size), header)
+    
+    # Bands map to disjoint channels, so they can be written in any order
+    index = 0
+    with _BandPool(workers) as pool:
+        for values in value_chunks:
+            for start in range(0, values.size, BAND_CHANNELS):
+                band = values[start:start + BAND_CHANNELS]
+                pool.submit(_put_scattered, views, order, index, band, bits_per_channel)
+                index += band.size
+            progress(HEADER_BITS + index, total_channels, "Embedding data in image")
+
+def _take_bits(bit_chunks, pending, count):
+    # Pull up to `count` elements from an iterator of arrays, returns (taken, leftover)
+    parts = [pending]
+    available = pending.size
+    while available < count:
+        bits = next(bit_chunks, None)
+        if bits is None:
+            break
+        parts.append(bits)
+        available += bits.size
+    bits = np.concatenate(parts)
+    return bits[:count], bits[count:]
+
+def _embed_in_strips(img, chunks, output, strip_rows=STRIP_ROWS, progress=None, bits_per_channel=1, use_alpha=False, compress_level=DEFAULT_COMPRESS_LEVEL, carrier=None):
+    # Streams the carrier strip by strip: each strip is copied out of the carrier,
+    # gets its share of payload bits and is written to the PNG right away
+    # carrier: path of img; uncompressed carriers are then read a strip at a time,
+    # any other carrier is decoded in full first, so only those keep memory bounded by the strip size
+    progress = progress or _no_progress
+    value_chunks = _iter_channel_values(chunks, bits_per_channel)
+    pending = np.empty(0, dtype=np.uint8)
+    channel = 0
+    
+    with _open_for_write(output) as f:
+        writer = _PngStripWriter(f, img.width, img.height, 4 if use_alpha else 3, compress_level)
+        for top, strip in _iter_strips(img, carrier, strip_rows, use_alpha):
+            for view in _pixel_views(strip, top * img.width, use_alpha):
+                values, pending = _take_bits(value_chunks, pending, view.size)
+                if values.size:
+                    _write_view(view, values, channel, bits_per_channel)
+                channel += view.size
+            writer.write_rows(strip)
+            progress(top + strip.shape[0], img.height, "Embedding data in image")
+        writer.close()
+
+def _iter_strips(img, carrier, strip_rows, use_alpha=False):
+    # (top row, writable copy of the rows) from top to bottom, RGBA with an opaque alpha when use_alpha
+    layout = _raw_pixel_layout(img) if isinstance(carrier, (str, os.PathLike)) else None
+    if layout is None:
+        _check_decode(img)
+        image = _as_mode(img, "RGBA" if use_alpha else "RGB")
+        for top in range(0, image.height, strip_rows):
+            yield top, np.array(image.crop((0, top, image.width, min(top + strip_rows, image.height))), dtype=np.uint8)
+        return
+    
+    # Read straight from the file bytes, as the in-place path does; the pages of each strip are
+    # dropped once it is copied, so the mapped file does not pile up in memory either
+    with open(carrier, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    top = 0
+    for view in _raw_views(np.frombuffer(mapped, dtype=np.uint8), img.width, layout):
+        for start in range(0, view.shape[0], strip_rows):
+            rows = view[start:start + strip_rows]
+            strip = np.empty(rows.shape[:2] + (4 if use_alpha else 3,), dtype=np.uint8)
+            strip[..., :3] = rows
+            strip[..., 3:] = 255
+            if hasattr(mmap, "MADV_DONTNEED"):
+                mapped.madvise(mmap.MADV_DONTNEED)
+            yield top, strip
+            top += rows.shape[0]
+
+class _PngStripWriter:
+    # Minimal streaming PNG encoder for 8-bit RGB or RGBA rows, using the Sub filter
+    def __init__(self, f, width, height, channels=3, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self._f = f
+        self._channels = channels
+        self._compressor = zlib.compressobj(compress_level)
+        color_type = 6 if channels == 4 else 2
+        f.write(b"\x89PNG\r\n\x1a\n")
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+    
+    def _write_chunk(self, tag, data):
+        self._f.write(struct.pack(">I", len(data)) + tag)
+        self._f.write(data)
+        self._f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
+    
+    def write_rows(self, rows):
+        rows = rows.reshape(rows.shape[0], -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        step = self._channels
+        filtered[:, 0] = 1  # Sub filter: each byte minus the same channel of the previous pixel
+        filtered[:, 1:step + 1] = rows[:, :step]
+        filtered[:, step + 1:] = rows[:, step:] - rows[:, :-step]
+        data = self._compressor.compress(filtered)
+        if data:
+            self._write_chunk(b"IDAT", data)
+    
+    def close(self):
+        self._write_chunk(b"IDAT", self._compressor.flush())
+        self._write_chunk(b"IEND", b"")
+
 def _get_lsb_bits(pixel):
     return ''.join(str(channel & 1) for channel in pixel[:3])  # R, G, B
 
+def _view_channels(views, start, stop):
+    # Channels [start, stop) across views of (rows, ..., channels) in row order,
+    # only the rows that hold those channels are touched
+    parts = []
+    base = 0
+    for view in views:
+        row_len = math.prod(view.shape[1:])
+        lo, hi = max(start - base, 0), min(stop - base, view.size)
+        if lo < hi:
+            first_row = lo // row_len
+            rows = np.ascontiguousarray(view[first_row:math.ceil(hi / row_len)])
+            parts.append(rows.reshape(-1)[lo - first_row * row_len:hi - first_row * row_len])
+        base += view.size
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.uint8)
+
+def _read_lsb_bytes(views, offset, length, bits_per_channel=1, order=None):
+    # Decode container bytes [offset, offset + length) from the channels holding them;
+    # reads either stay inside the header or start after it
+    # order: keyed order of the channels after the header, from _scatter_order
+    start, stop = offset * 8, (offset + length) * 8
+    if stop <= HEADER_BITS:
+        return _pack_bits(_view_channels(views, start, stop) & 1)
+    
+    start, stop = start - HEADER_BITS, stop - HEADER_BITS
+    first, last = start // bits_per_channel, math.ceil(stop / bits_per_channel)
+    if order is None:
+        values = _view_channels(views, HEADER_BITS + first, HEADER_BITS + last)
+    else:
+        values = _gather_scattered(views, order, first, last)
+    bits = _ungroup_bits(values, bits_per_channel)
+    skip = start - first * bits_per_channel
+    return _pack_bits(bits[skip:skip + stop - start])
+
+def _raw_pixel_layout(img):
+    # [(top, bottom, offset, rawmode, stride, orientation)] when the RGB pixels sit
+    # uncompressed at fixed offsets in the file, None when PIL has to decode them
+    if img.format not in RAW_FORMATS or img.mode != "RGB":
+        return None
+    
+    layout = []
+    for codec, (x0, y0, x1, y1), offset, args in img.tile:
+        if isinstance(args, str):
+            args = (args,)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 and args[1] else img.width * 3
+        orientation = args[2] if len(args) > 2 else 1
+        if codec != "raw" or rawmode not in ("RGB", "BGR") or (x0, x1) != (0, img.width):
+            return None
+        layout.append((y0, y1, offset, rawmode, stride, orientation))
+    return sorted(layout)
+
+def _open_image(source):
+    # Image.open without PIL's decompression bomb check, which counts every pixel on open even
+    # though the raw and header-only paths never decode them; _check_decode applies it where they are
+    with _OPEN_LOCK:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(source)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+def _check_decode(img):
+    # PIL's own limit, for images about to be decoded through it; after _decode_rows it
+    # only counts the rows that will be decoded
+    Image._decompression_bomb_check(img.size)
+
+def _decode_rows(img, rows):
+    # Limits a freshly opened image to its top `rows` rows before it is loaded, so PIL only
+    # decodes the tiles and rows covering them; returns None when it has to decode everything
+    if not img.tile or img.info.get("interlace"):
+        return None
+    rows = min(rows, img.height)
+    tiles = []
+    for codec, (x0, y0, x1, y1), offset, args in img.tile:
+        # Bottom-up raw data starts with the last row, so it cannot be cut short
+        orientation = args[2] if codec == "raw" and isinstance(args, tuple) and len(args) > 2 else 1
+        if codec not in TOP_DOWN_DECODERS or orientation < 0:
+            return None
+        if y0 < rows:
+            tiles.append((codec, (x0, y0, x1, min(y1, rows)), offset, args))
+    img.tile = tiles
+    img._size = (img.width, rows)
+    return img
+
+def _raw_views(buffer, width, layout):
+    # (rows, width, 3) RGB views straight over the file bytes, in top-down row order
+    views = []
+    for top, bottom, offset, rawmode, stride, orientation in layout:
+        # The sizes come from the file header, so check they stay inside the file
+        if stride < width * 3 or offset + stride * (bottom - top) > buffer.size:
+            raise ValueError("Image file is truncated or its header is invalid.")
+        rows = np.ndarray((bottom - top, stride), dtype=np.uint8, buffer=buffer, offset=offset)
+        view = rows[:, :width * 3].reshape(bottom - top, width, 3)
+        if orientation < 0:
+            view = view[::-1]
+        if rawmode == "BGR":
+            view = view[..., ::-1]
+        views.append(view)
+    return views
+
+def _embed_in_views(views, chunks, strip_rows=STRIP_ROWS, total=None, progress=None, bits_per_channel=1, workers=1):
+    # Writes payload bits into the views band by band and stops after the last bit,
+    # so only the rows that carry data are read or written
+    progress = progress or _no_progress
+    total_channels = _channels_needed(total, bits_per_channel) if total else sum(view.size for view in views)
+    value_chunks = _iter_channel_values(chunks, bits_per_channel)
+    pending = np.empty(0, dtype=np.uint8)
+    channel = 0
+    with _BandPool(workers) as pool:
+        for view in views:
+            for top in range(0, view.shape[0], strip_rows):
+                band = view[top:top + strip_rows]
+                values, pending = _take_bits(value_chunks, pending, band.size)
+                if not values.size:
+                    return
+                pool.submit(_write_view, band, values, channel, bits_per_channel)
+                channel += values.size
+                progress(channel, total_channels, "Embedding data in image")
+
+def _is_raw_carrier(img, output_format):
+    # The in-place path needs the output to be written in the carrier's own format
+    return output_format == img.format and _raw_pixel_layout(img) is not None
+
+# Compatibility shims for '0'/'1' string callers, prefer the helpers above
 def _parse_sizes(bits):
-    size = int(bits[:32], 2)
-    ext_size = int(bits[32:64], 2)
-    return size, ext_size
+    return _LEGACY_HEADER_STRUCT.unpack_from(_bits_to_bytes(bits[:LEGACY_HEADER_BYTES * 8]))
 
 def _bits_to_bytes(bits):
-    return bytes(int(bits[i:i + 8], 2) for i in range(0, len(bits), 8))
+    return _pack_bits(np.frombuffer(bits.encode('ascii'), dtype=np.uint8) - ord('0'))
+
+def _no_progress(current, total, task_name):
+    pass
+
+def prompt_passphrase(confirm=False):
+    # Passphrase for the command line tools: PASSPHRASE_ENV when set, otherwise asked for on the terminal
+    passphrase = os.environ.get(PASSPHRASE_ENV)
+    if passphrase is not None:
+        return passphrase
+    import getpass
+    passphrase = getpass.getpass("Passphrase: ")
+    if confirm and getpass.getpass("Repeat passphrase: ") != passphrase:
+        raise SystemExit("Passphrases do not match.")
+    return passphrase
+
+def console_progress(file=None):
+    # Progress callback drawing the console bar, redrawn only when it moves by 5%
+    # file: where to draw it, stdout by default
+    last_progress = {}
+    
+    def report(current, total, task_name):
+        percent = int(current / total * 100 // 5 * 5) if total else 100
+        if percent > last_progress.get(task_name, -1):
+            _print_progress(current, total, task_name, percent, file)
+            last_progress[task_name] = percent
+    
+    return report
 
-def _print_progress(current, total, task_name, percent):
+def _print_progress(current, total, task_name, percent, file=None):
     bar_length = 50
     block = int(round(bar_length * percent / 100))
     progress = f"\r{task_name}: [{'#' * block}{'-' * (bar_length - block)}] {percent:.2f}%"
-    print(progress, end='')
+    print(progress, end='', file=file)
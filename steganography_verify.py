@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import functools
+from steganography_extract import verify
+from steganography_inspect import _map_images
+from steganography_utils import PASSPHRASE_ENV, prompt_passphrase
+
+def verify_many(paths, workers=None, key=None, passphrase=None):
+    # Yields a report per image, in order; directories are expanded to the images they hold.
+    # Nothing is written, and a damaged image is given up on at its first bad frame
+    yield from _map_images(functools.partial(_verify_report, key=key, passphrase=passphrase), paths, workers)
+
+def _verify_report(image_path, key=None, passphrase=None):
+    try:
+        checksum = verify(image_path, key, passphrase)
+    except Exception as e:
+        return {"image": image_path, "status": "error", "error": str(e)}
+    # Legacy files, and encrypted files without frames checked without their passphrase, vouch for nothing
+    return {"image": image_path, "status": "ok" if checksum else "unverified", "checksum": checksum}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check the hidden files of images against their checksums without extracting them.")
+    parser.add_argument('-i', '--image', required=True, nargs='+', help="Images or directories of images to verify.")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="Number of worker threads.")
+    parser.add_argument('-k', '--key', help="The key the files were hidden with.")
+    parser.add_argument('-e', '--encrypted', action='store_true', help=f"Also check the tags of encrypted files, asking for the passphrase or taking it from ${PASSPHRASE_ENV}.")
+    parser.add_argument('--failed-only', action='store_true', help="Only report images that did not verify.")
+
+    args = parser.parse_args()
+    passphrase = prompt_passphrase() if args.encrypted else None
+    failed = 0
+    for report in verify_many(args.image, args.workers, args.key, passphrase):
+        failed += report["status"] == "error"
+        if report["status"] != "ok" or not args.failed_only:
+            print(json.dumps(report), flush=True)
+    sys.exit(1 if failed else 0)